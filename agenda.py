@@ -3,26 +3,155 @@
    Author: FIXME for CIS 210, U. Oregon
 
    Each Appt has a date, a start time, an end time, and
-   a textual description.   They can be converted to and
+   a textual description.  An Appt may end on a later day
+   than it starts, like a conference or an overnight trip.   They can be converted to and
    from strings, using the from_string class method and the __str__
    method.  An Agenda can be read from a file using the
-   from_file class method.  Intersecting Agendas produces
+   from_file class method, or a file can be read one Appt
+   at a time with iter_appts and fed to the streaming
+   iter_complement and iter_intersect.  Intersecting Agendas produces
    a new Agenda whose Appts are periods that are in the overlap
    of Appts in the first and second Agenda.
    
 
 """
 
+import bisect
+import collections
 import datetime
+import heapq
+import itertools
+import random
+import re
+
+# Appointment times are kept as whole minutes since the epoch.
+# Naive times count wall-clock minutes; times with a tzinfo count
+# minutes since the epoch in UTC, so they compare correctly across
+# time zones.
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MINUTE = datetime.timedelta(minutes=1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+# "HH:MM" for each minute of the day
+CLOCK = ["{:02d}:{:02d}".format(minute // 60, minute % 60)
+         for minute in range(24 * 60)]
+
+def to_minutes(dt):
+    """Minutes since the epoch of a datetime.datetime,
+    truncated to the minute.
+    """
+    if dt.tzinfo is None:
+        return (dt - EPOCH) // MINUTE
+    return (dt - EPOCH_UTC) // MINUTE
+
+def from_minutes(minutes, tzinfo=None):
+    """The datetime.datetime that is minutes since the
+    epoch, in time zone tzinfo (naive if tzinfo is None).
+    """
+    if tzinfo is None:
+        return EPOCH + datetime.timedelta(minutes=minutes)
+    return (EPOCH_UTC + datetime.timedelta(minutes=minutes)).astimezone(tzinfo)
+
+# Appointment text as written by Appt.__str__:
+#     2012.10.31 13:00 13:50 | CIS 210 lecture
+#     2012.10.31 22:00 2012.11.01 06:00 | overnight
+APPT_PATTERN = re.compile(r"\s*([0-9]{4}\.[0-9]{1,2}\.[0-9]{1,2})"
+                          r"\s+([0-9]{1,2}):([0-9]{2})"
+                          r"\s+(?:([0-9]{4}\.[0-9]{1,2}\.[0-9]{1,2})\s+)?"
+                          r"([0-9]{1,2}):([0-9]{2})"
+                          r"\s*\|([^|]*)$")
+
+# Minutes since the epoch at the start of each day text seen
+# by day_minute.  There are few distinct days in an agenda.
+_day_minutes = { }
+_DAY_CACHE_SIZE = 4096
+
+def day_minute(text):
+    """Minutes since the epoch at the start of a day written
+    as Year.Month.Day (like 2012.10.31), or None if that is
+    not a real date.
+    """
+    minute = _day_minutes.get(text)
+    if minute is None:
+        year, month, day = text.split(".")
+        try:
+            date = datetime.date(int(year), int(month), int(day))
+        except ValueError:
+            return None
+        minute = (date.toordinal() - EPOCH_ORDINAL) * 24 * 60
+        if len(_day_minutes) >= _DAY_CACHE_SIZE:
+            _day_minutes.clear()
+        _day_minutes[text] = minute
+    return minute
+
+# Timestamps in RFC 3339, as in Google Calendar events:
+#     2016-12-11T10:00:00-08:00   or   2016-12-11T18:00:00.000Z
+# or just a date, as for all-day events:
+#     2016-12-11
+RFC3339_PATTERN = re.compile(r"([0-9]{4}-[0-9]{2}-[0-9]{2})"
+                             r"(?:[Tt ]([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.[0-9]+)?"
+                             r"(?:[Zz]|([+-])([0-9]{2}):([0-9]{2})))?$")
+
+# One datetime.timezone for each UTC offset (in minutes) seen by
+# fixed_zone, so appointments in the same zone share their tzinfo.
+_zones = { }
+
+def fixed_zone(offset):
+    """The time zone offset minutes ahead of UTC."""
+    zone = _zones.get(offset)
+    if zone is None:
+        zone = datetime.timezone(datetime.timedelta(minutes=offset))
+        _zones[offset] = zone
+    return zone
+
+def parse_rfc3339(text):
+    """Read an RFC 3339 timestamp (like 2016-12-11T10:00:00-08:00)
+    or date (like 2016-12-11).
+
+    Returns:
+        (minute, second, offset): The wall-clock time as minutes
+        since the epoch (see to_minutes) and seconds past that
+        minute, and the UTC offset in minutes.  The time in UTC is
+        minute - offset.  A date is its midnight, with offset None:
+        it is in whatever time zone the reader is in.
+    Raises:
+        ValueError if text is not an RFC 3339 timestamp
+    """
+    match = RFC3339_PATTERN.match(text)
+    if match is None:
+        raise ValueError("Not an RFC 3339 timestamp: '{}'".format(text))
+    day = day_minute(match.group(1).replace("-", "."))
+    if match.group(2) is None:
+        if day is None:
+            raise ValueError("Not an RFC 3339 date: '{}'".format(text))
+        return day, 0, None
+    hour, minute, second = map(int, match.group(2, 3, 4))
+    if day is None or hour > 23 or minute > 59 or second > 60:
+        raise ValueError("Not an RFC 3339 timestamp: '{}'".format(text))
+    offset = 0
+    if match.group(5) is not None:
+        offset = int(match.group(6)) * 60 + int(match.group(7))
+        if match.group(5) == "-":
+            offset = -offset
+    return day + hour * 60 + minute, second, offset
 
 class Appt:
 
     """
     A single appointment, starting on a particular
-    date and time, and ending at a later time the same day.
+    date and time, and ending at a later time the same day
+    or a later day.
+
+    Begin and end are stored as integer minutes since the
+    epoch (begin_minute, end_minute) together with the time
+    zone they were given in (tzinfo).  The begin and end
+    datetimes are built from these on demand.
     """
+
+    __slots__ = ("begin_minute", "end_minute", "tzinfo", "desc")
     
-    def __init__(self, day, begin, end, desc):
+    def __init__(self, day, begin, end, desc, end_day=None):
         """Create an appointment on date
         from begin time to end time.
         
@@ -32,6 +161,8 @@ class Appt:
             end:  A datetime.time object, 
                 after begin.                When the appointments ends.
             desc: A string describing the appointment
+            end_day: (optional) A datetime.date object, the day
+                the appointment ends if not the day it starts.
             
         Raises: 
         	ValueError if appointment ends before it begins
@@ -42,42 +173,123 @@ class Appt:
                 datetime.time(17,45))
             (December 1 from 4:30pm to 5:45pm)
         """
-        self.begin = datetime.datetime.combine(day, begin)
-        self.end = datetime.datetime.combine(day, end)
-        if begin >= end :
+        begin = datetime.datetime.combine(day, begin)
+        end = datetime.datetime.combine(end_day or day, end)
+        self.begin_minute = to_minutes(begin)
+        self.end_minute = to_minutes(end)
+        if self.begin_minute >= self.end_minute :
             raise ValueError("Appointment end must be after begin")
+        self.tzinfo = begin.tzinfo
         self.desc = desc
         return
 
+    @classmethod
+    def from_minutes(cls, begin, end, desc, tzinfo=None):
+        """Factory creates an Appt directly from minutes since
+        the epoch, without building any datetimes.
+
+        Arguments:
+            begin: Minutes since the epoch when the appointment starts.
+            end:   Minutes since the epoch when it ends, after begin.
+            desc:  A string describing the appointment
+            tzinfo: Time zone of begin and end (see to_minutes),
+                or None for naive wall-clock minutes.
+        Raises:
+            ValueError if appointment ends before it begins
+        """
+        if begin >= end:
+            raise ValueError("Appointment end must be after begin")
+        appt = cls.__new__(cls)
+        appt.begin_minute = begin
+        appt.end_minute = end
+        appt.tzinfo = tzinfo
+        appt.desc = desc
+        return appt
+
+    @property
+    def begin(self):
+        """When the appointment starts, as a datetime.datetime"""
+        return from_minutes(self.begin_minute, self.tzinfo)
+
+    @property
+    def end(self):
+        """When the appointment ends, as a datetime.datetime"""
+        return from_minutes(self.end_minute, self.tzinfo)
+
     @classmethod
     def from_string(cls, txt):
-        """Factory parses a string to create an Appt"""
+        """Factory parses a string to create an Appt.
+
+        Well-formed text (see __str__) is matched with a
+        precompiled pattern and converted straight to minutes;
+        anything else goes through the strict parser, which
+        explains what is wrong with it.
+
+        Raises:
+            ValueError if txt is not a valid appointment
+        """
+        match = APPT_PATTERN.match(txt)
+        if match is not None:
+            day = day_minute(match.group(1))
+            end_day = day if match.group(4) is None else day_minute(match.group(4))
+            begin_hour, begin_min, end_hour, end_min = map(int, match.group(2, 3, 5, 6))
+            if (day is not None and end_day is not None and begin_hour < 24
+                    and end_hour < 24 and begin_min < 60 and end_min < 60):
+                begin = day + begin_hour * 60 + begin_min
+                end = end_day + end_hour * 60 + end_min
+                if begin < end:
+                    return Appt.from_minutes(begin, end, match.group(7).strip())
+        return cls.from_string_strict(txt)
+
+    @classmethod
+    def from_strings(cls, lines):
+        """Factory parses many strings at once.
+
+        Arguments:
+            lines: An iterable of appointment strings
+        Returns:
+            A list of Appts, in the same order
+        Raises:
+            ValueError on the first line that is not a valid appointment
+        """
+        from_string = cls.from_string
+        return [from_string(line) for line in lines]
+
+    @classmethod
+    def from_string_strict(cls, txt):
+        """Factory parses a string to create an Appt, field by field"""
         fields = txt.split("|")
         if len(fields) != 2:
             raise ValueError("Appt literal requires exactly one '|' before description")
         timespec = fields[0].strip()
         desc = fields[1].strip()
         fields = timespec.split()
-        if len(fields) != 3:
-            raise ValueError("Appt literal must start with date, time, time, separated by blanks")
+        if len(fields) not in (3, 4):
+            raise ValueError("Appt literal must start with date, time, (date,) time, separated by blanks")
         appt_date_text = fields[0]
         appt_begin_text = fields[1]
-        appt_end_text = fields[2]
-        fields = appt_date_text.split(".")
-        try:
-            year = int(fields[0].strip())
-            month = int(fields[1].strip())
-            day = int(fields[2].strip())
-        except:
-            raise ValueError("Date in Appt literal should be 9999.99.99 (Year.Month.Day)")
+        appt_end_text = fields[-1]
 
         ### 
-        date = datetime.date(year,month,day)
+        date = cls._date_from_text(appt_date_text)
+        end_date = cls._date_from_text(fields[2]) if len(fields) == 4 else None
         begin = datetime.datetime.strptime(appt_begin_text, "%H:%M").time()
         end =   datetime.datetime.strptime(appt_end_text, "%H:%M").time()
 
-        result = Appt(date, begin, end, desc)
+        result = Appt(date, begin, end, desc, end_date)
         return result   
+
+    @staticmethod
+    def _date_from_text(text):
+        """The datetime.date written as Year.Month.Day"""
+        fields = text.split(".")
+        try:
+            year = int(fields[0].strip())
+            month = int(fields[1].strip())
+            day = int(fields[2].strip())
+        except:
+            raise ValueError("Date in Appt literal should be 9999.99.99 (Year.Month.Day)")
+        return datetime.date(year,month,day)
         
     def __lt__(self, other):
         """Does this appointment finish before other begins?
@@ -87,7 +299,7 @@ class Appt:
         Returns: 
         	True iff this Appt is done by the time other begins.
         """
-        return self.end <= other.begin
+        return self.end_minute <= other.begin_minute
         
     def __gt__(self, other):
         """Does other appointment finish before this begins?
@@ -108,7 +320,8 @@ class Appt:
             True iff there exists some duration (greater than zero)
             between this Appt and other. 
         """
-        return  not (self < other or other < self)
+        return (self.begin_minute < other.end_minute and
+                other.begin_minute < self.end_minute)
             
     def intersect(self, other, desc=""):
         """Return an appointment representing the period in
@@ -128,12 +341,11 @@ class Appt:
         if desc=="":
             desc = self.desc
         assert(self.overlaps(other))
-        # We know the day must be the same. 
         # Find overlap of times: 
         #   Later of two begin times, earlier of two end times
-        begin_time = max(self.begin.time(), other.begin.time())
-        end_time = min(self.end.time(), other.end.time())
-        return Appt(self.begin.date(), begin_time, end_time, desc)
+        begin = max(self.begin_minute, other.begin_minute)
+        end = min(self.end_minute, other.end_minute)
+        return Appt.from_minutes(begin, end, desc, self.tzinfo)
 
     def union(self, other, desc=""):
         """Return an appointment representing the combined period in
@@ -153,12 +365,11 @@ class Appt:
         if desc=="":
             desc = self.desc + " " + other.desc
         assert(self.overlaps(other))
-        # We know the day must be the same. 
         # Find overlap of times: 
         #   Earlier of two begin times, later of two end times
-        begin = min(self.begin, other.begin)
-        end = max(self.end, other.end)
-        return Appt(self.begin.date(), begin.time(), end.time(), desc)
+        begin = min(self.begin_minute, other.begin_minute)
+        end = max(self.end_minute, other.end_minute)
+        return Appt.from_minutes(begin, end, desc, self.tzinfo)
 
     def __str__(self):
         """String representation of appointment.
@@ -167,13 +378,302 @@ class Appt:
             
         This format is designed to be easily divided
         into parts:  Split on '|', then split on whitespace,
-        then split date on '.' and times on ':'.
+        then split date on '.' and times on ':'.  An appointment
+        ending on a later day has the end date before the end time:
+            2012.10.31 22:00 2012.11.01 06:00 | overnight
         """
-        daystr = self.begin.date().strftime("%Y.%m.%d ")
-        begstr = self.begin.strftime("%H:%M ")
-        endstr = self.end.strftime("%H:%M ")
+        begin = self.begin
+        end = self.end
+        daystr = begin.date().strftime("%Y.%m.%d ")
+        begstr = begin.strftime("%H:%M ")
+        endstr = end.strftime("%H:%M ")
+        if end.date() != begin.date():
+            endstr = end.date().strftime("%Y.%m.%d ") + endstr
         return daystr + begstr + endstr + "| " + self.desc
 
+def _utc_seconds(t):
+    """Seconds past midnight UTC of a datetime.time with a
+    tzinfo (not wrapped around midnight, as time comparison).
+    """
+    seconds = t.hour * 3600 + t.minute * 60 + t.second
+    offset = t.utcoffset()
+    if offset is not None:
+        seconds -= offset // datetime.timedelta(seconds=1)
+    return seconds
+
+ParseError = collections.namedtuple("ParseError", ["lineno", "text", "reason"])
+ParseError.__doc__ = """A line of an agenda file that could not be read:
+line number (from 1), the text of the line, and why it failed."""
+
+def iter_appts(f, errors=None):
+    """Generator: the Appts in a file, one at a time, so
+    an agenda file need not fit in memory.
+
+    Blank lines and lines starting with '#' are skipped.
+    Lines that are not valid Appts are skipped too; if errors
+    is a list, a ParseError for each is appended to it.
+
+    Arguments:
+        f:  A file object or anything that yields lines
+        errors: (optional) A list to collect ParseErrors in
+    Yields:
+        Appt objects, in file order
+    """
+    for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            # Skip blank lines and comments
+            continue
+        try:
+            appt = Appt.from_string(line)
+        except ValueError as err:
+            if errors is not None:
+                errors.append(ParseError(lineno, line, str(err)))
+            continue
+        yield appt
+
+def iter_normalized(appts):
+    """Generator: merge overlapping appointments, as
+    Agenda.normalize does, from an iterable of Appts that
+    is already in order by begin time.
+    """
+    cur = None
+    for appt in appts:
+        if cur is None:
+            cur = appt
+        elif appt > cur:
+            yield cur
+            cur = appt
+        else:
+            cur = cur.union(appt)
+    if cur is not None:
+        yield cur
+
+def iter_complement(appts, freeblocks):
+    """Generator version of Agenda.complement for streams: the
+    times within freeblocks that are not within appts.
+
+    Arguments:
+        appts: Iterable of Appts in order by begin time
+            (overlaps are merged as they arrive).
+        freeblocks: Iterable of Appts in order, not overlapping
+            each other (like one per day).
+    Yields:
+        Appts described as the freeblock they fall in, in order.
+    """
+    appts = iter_normalized(appts)
+    appt = next(appts, None)
+    for freeblock in freeblocks:
+        cur_time = freeblock.begin_minute
+        while appt is not None and appt.end_minute <= cur_time:
+            appt = next(appts, None)
+        while appt is not None and appt.begin_minute < freeblock.end_minute:
+            if cur_time < appt.begin_minute:
+                yield Appt.from_minutes(cur_time, appt.begin_minute,
+                                        freeblock.desc, freeblock.tzinfo)
+            cur_time = max(appt.end_minute, cur_time)
+            if appt.end_minute > freeblock.end_minute:
+                # Keep it; it may cover the next freeblock too
+                break
+            appt = next(appts, None)
+        if cur_time < freeblock.end_minute:
+            yield Appt.from_minutes(cur_time, freeblock.end_minute,
+                                    freeblock.desc, freeblock.tzinfo)
+
+def iter_intersect(mine, theirs, desc=""):
+    """Generator version of Agenda.intersect for streams: the
+    overlaps between two iterables of Appts, each in order by
+    begin time.  Each stream is normalized as it is read, so
+    this gives the result of intersecting the normalized agendas.
+    Titles come from mine unless overridden by desc.
+    """
+    mine = iter_normalized(mine)
+    theirs = iter_normalized(theirs)
+    thisappt = next(mine, None)
+    otherappt = next(theirs, None)
+    while thisappt is not None and otherappt is not None:
+        if thisappt.overlaps(otherappt):
+            yield thisappt.intersect(otherappt, desc)
+        if thisappt.end_minute <= otherappt.end_minute:
+            thisappt = next(mine, None)
+        else:
+            otherappt = next(theirs, None)
+
+
+class IntervalIndex:
+    """An index over a set of appointments for point and
+    range queries: is this person busy at time t, and which
+    appointments touch a window of time.
+
+    Appointments are kept in a balanced binary search tree
+    ordered by begin time (a treap: each node has a random
+    priority, and parents have higher priorities than their
+    children), where each node also records the latest end of
+    any appointment below it.  Inserts and removes take
+    O(log n) time.  A query skips every subtree whose latest
+    end is before the window, and every right subtree beginning
+    after it, so it costs O(log n) plus the appointments it
+    finds; one very long appointment does not slow it down.
+    """
+
+    def __init__(self, appts=()):
+        """An index of appts (any iterable of Appt)."""
+        appts = sorted(appts, key=lambda appt: appt.begin_minute)
+        self._count = 0
+        self._keys = { }
+        nodes = [self._node(appt) for appt in appts]
+        self._rand = random.Random()
+        # A balanced tree to start with, with priorities by depth
+        # above those of later inserts (from 0 to 1), so it stays
+        # a treap.
+        depth = len(nodes).bit_length()
+        def build(lo, hi, level):
+            if lo >= hi:
+                return None
+            mid = (lo + hi) // 2
+            node = nodes[mid]
+            node.priority = depth - level + self._rand.random()
+            node.left = build(lo, mid, level + 1)
+            node.right = build(mid + 1, hi, level + 1)
+            _update(node)
+            return node
+        self._root = build(0, len(nodes), 0)
+        self._size = len(nodes)
+
+    def _node(self, appt):
+        """A new tree node for appt.  Appointments that begin at
+        the same time are ordered by when they were added.
+        """
+        self._count += 1
+        key = (appt.begin_minute, self._count)
+        self._keys.setdefault(id(appt), [ ]).append(key)
+        return _Node(key, appt)
+
+    def insert(self, appt):
+        """Add an Appt to the index."""
+        node = self._node(appt)
+        node.priority = self._rand.random()
+        self._root = _insert(self._root, node)
+        self._size += 1
+
+    def remove(self, appt):
+        """Remove this Appt (the same object) from the index.
+        Raises ValueError if it is not in the index.
+        """
+        keys = self._keys.get(id(appt))
+        if not keys:
+            raise ValueError("Appointment is not in the index")
+        key = keys.pop()
+        if not keys:
+            del self._keys[id(appt)]
+        self._root = _remove(self._root, key)
+        self._size -= 1
+
+    def _touching(self, begin, end):
+        """Appointments overlapping minutes begin to end, in order."""
+        found = [ ]
+        def visit(node):
+            while node is not None and node.max_end > begin:
+                visit(node.left)
+                if node.key[0] >= end:
+                    return
+                if node.appt.end_minute > begin:
+                    found.append(node.appt)
+                node = node.right
+        visit(self._root)
+        return found
+
+    def busy_at(self, t):
+        """Is some appointment in progress at datetime t?"""
+        minute = to_minutes(t)
+        return len(self._touching(minute, minute + 1)) > 0
+
+    def overlapping(self, window):
+        """List of the appointments that overlap window (an Appt),
+        in order by begin time.
+        """
+        return self._touching(window.begin_minute, window.end_minute)
+
+    def __len__(self):
+        """Number of appointments in the index"""
+        return self._size
+
+
+class _Node:
+    """A node of the IntervalIndex tree."""
+
+    __slots__ = ("key", "appt", "priority", "max_end", "left", "right")
+
+    def __init__(self, key, appt):
+        self.key = key
+        self.appt = appt
+        self.priority = 0.0
+        self.max_end = appt.end_minute
+        self.left = None
+        self.right = None
+
+def _update(node):
+    """Recompute node.max_end from its appointment and children."""
+    max_end = node.appt.end_minute
+    if node.left is not None and node.left.max_end > max_end:
+        max_end = node.left.max_end
+    if node.right is not None and node.right.max_end > max_end:
+        max_end = node.right.max_end
+    node.max_end = max_end
+
+def _insert(root, node):
+    """The tree root with node added (rotated up to its priority)."""
+    if root is None:
+        return node
+    if node.key < root.key:
+        root.left = _insert(root.left, node)
+        if root.left.priority > root.priority:
+            child = root.left
+            root.left = child.right
+            child.right = root
+            _update(root)
+            _update(child)
+            return child
+    else:
+        root.right = _insert(root.right, node)
+        if root.right.priority > root.priority:
+            child = root.right
+            root.right = child.left
+            child.left = root
+            _update(root)
+            _update(child)
+            return child
+    _update(root)
+    return root
+
+def _remove(root, key):
+    """The tree root without the node for key."""
+    if root is None:
+        raise ValueError("Appointment is not in the index")
+    if key < root.key:
+        root.left = _remove(root.left, key)
+    elif key > root.key:
+        root.right = _remove(root.right, key)
+    else:
+        return _join(root.left, root.right)
+    _update(root)
+    return root
+
+def _join(left, right):
+    """One tree of two, every key in left before every key in right."""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _join(left.right, right)
+        _update(left)
+        return left
+    right.left = _join(left, right.left)
+    _update(right)
+    return right
+
+
 class Agenda:
     """An Agenda is essentially a list of appointments,
     with some agenda-specific methods.
@@ -182,34 +682,138 @@ class Agenda:
     def __init__(self):
         """An empty agenda."""
         self.appts = [ ]
+        self._index = None
         
     @classmethod
-    def from_file(cls, f):
+    def from_file(cls, f, errors=None):
         """Factory: Read an agenda from a file.
         
         Arguments: 
             f:  A file object (as returned by io.open) or
                an object that emulates a file (like stringio). 
+            errors: (optional) A list; a ParseError is appended
+               to it for each line that is not a valid Appt.
         returns: 
             An Agenda object
         """
         agenda = cls()
-        for line in f:
-            line = line.strip()
-            if line == "" or line.startswith("#"):
-                # Skip blank lines and comments
-                pass
-            else: 
-                try: 
-                    agenda.append(Appt.from_string(line))
-                except ValueError as err: 
-                    print("Failed on line: ", line)
-                    print(err)
+        for appt in iter_appts(f, errors):
+            agenda.append(appt)
+        return agenda
+
+    @classmethod
+    def from_events(cls, events, begin_time=None, end_time=None, tzinfo=None):
+        """Factory: An agenda of calendar events.
+
+        Arguments:
+            events: Dicts with 'start_time' and 'end_time' (RFC 3339
+               timestamps or dates, see parse_rfc3339) and 'summary'
+            begin_time, end_time: (optional) datetime.time objects
+               with a tzinfo.  Events within one day that end before
+               begin_time or start after end_time, by time of day,
+               are left out.  (Use clip for longer events.)
+            tzinfo: (optional) The user's time zone.  The Appts are
+               in this time zone, and all-day events run from midnight
+               to midnight in it.  If None, each Appt is in the time
+               zone of its start and all-day events are in UTC.
+        returns:
+            An Agenda (of this class) with an Appt for each remaining
+            event.  Events shorter than a minute (including zero-length
+            events) are left out, as Appts are whole minutes.
+
+        Each timestamp is parsed once, and times of day are compared
+        as seconds past midnight UTC, as datetime.time compares
+        times with a tzinfo.
+        """
+        earliest = -float("inf") if begin_time is None else _utc_seconds(begin_time)
+        latest = float("inf") if end_time is None else _utc_seconds(end_time)
+        midnights = { }
+        def midnight_offset(day):
+            """UTC offset of tzinfo at the start of day (in minutes)"""
+            offset = midnights.get(day)
+            if offset is None:
+                offset = 0
+                if tzinfo is not None:
+                    offset = from_minutes(day).replace(tzinfo=tzinfo).utcoffset() // MINUTE
+                midnights[day] = offset
+            return offset
+        agenda = cls()
+        for event in events:
+            start, start_second, start_offset = parse_rfc3339(event["start_time"])
+            end, end_second, end_offset = parse_rfc3339(event["end_time"])
+            if start_offset is None:
+                start_offset = midnight_offset(start)
+            if end_offset is None:
+                end_offset = midnight_offset(end)
+            if (start // 1440 == end // 1440 and
+                    ((end % 1440 - end_offset) * 60 + end_second < earliest or
+                     (start % 1440 - start_offset) * 60 + start_second > latest)):
+                continue
+            begin_minute = start - start_offset
+            end_minute = end - end_offset
+            if end_minute <= begin_minute:
+                # Zero-length, or within one minute (like 10:00:10 to
+                # 10:00:50): nothing left once truncated to minutes
+                continue
+            agenda.append(Appt.from_minutes(begin_minute, end_minute, event["summary"],
+                                            tzinfo or fixed_zone(start_offset)))
+        return agenda
+
+    @classmethod
+    def daily(cls, first_day, last_day, begin, end, desc, tzinfo=None):
+        """Factory: An agenda with an appointment from begin to end
+        on each day from first_day through last_day.
+
+        Arguments:
+            first_day, last_day: datetime.date objects
+            begin, end: datetime.time objects, wall-clock times
+               without a tzinfo
+            desc: A string describing each appointment
+            tzinfo: (optional) The time zone of begin and end.  Each
+               day is converted with its own UTC offset, so the
+               appointments stay at begin and end local time across
+               daylight saving changes.
+        returns:
+            An Agenda, in order by day
+        """
+        agenda = cls()
+        begin = begin.replace(tzinfo=tzinfo)
+        end = end.replace(tzinfo=tzinfo)
+        day = first_day
+        while day <= last_day:
+            agenda.append(Appt(day, begin, end, desc))
+            day += datetime.timedelta(days=1)
         return agenda
 
     def append(self,appt):
         """Add an Appt to the agenda."""
         self.appts.append(appt)
+        if self._index is not None:
+            self._index.insert(appt)
+
+    def index(self):
+        """An IntervalIndex of the appointments in this agenda,
+        built on first use.  append keeps it up to date and
+        normalize discards it; code that changes self.appts
+        directly should call reindex.
+        """
+        if self._index is None:
+            self._index = IntervalIndex(self.appts)
+        return self._index
+
+    def reindex(self):
+        """Discard the index, so the next call to index rebuilds it."""
+        self._index = None
+
+    def busy_at(self, t):
+        """Is some appointment in this agenda in progress at datetime t?"""
+        return self.index().busy_at(t)
+
+    def overlapping(self, window):
+        """List of the appointments in this agenda that overlap
+        window (an Appt), in order by begin time.
+        """
+        return self.index().overlapping(window)
 
     def intersect(self,other,desc=""): 
         """Return a new agenda containing appointments
@@ -225,15 +829,132 @@ class Agenda:
            desc:  If provided, this string becomes the title of
                 all the appointments in the result.
         """
+        # Sweep both agendas in order of begin time, keeping the
+        # appointments that are still open on each side.  Each
+        # appointment is paired with the open appointments of the
+        # other side when it begins, so every overlapping pair is
+        # found exactly once without comparing all pairs.
+        mine = sorted(range(len(self.appts)),
+                      key=lambda i: self.appts[i].begin_minute)
+        theirs = sorted(range(len(other.appts)),
+                        key=lambda j: other.appts[j].begin_minute)
+        open_mine = [ ]
+        open_theirs = [ ]
+        pairs = [ ]
+        i = 0
+        j = 0
+        while i < len(mine) or j < len(theirs):
+            if j == len(theirs) or (i < len(mine) and
+                    self.appts[mine[i]].begin_minute <=
+                    other.appts[theirs[j]].begin_minute):
+                thisappt = self.appts[mine[i]]
+                open_theirs = [k for k in open_theirs
+                               if other.appts[k].end_minute > thisappt.begin_minute]
+                pairs.extend((mine[i], k) for k in open_theirs)
+                open_mine.append(mine[i])
+                i += 1
+            else:
+                otherappt = other.appts[theirs[j]]
+                open_mine = [k for k in open_mine
+                             if self.appts[k].end_minute > otherappt.begin_minute]
+                pairs.extend((k, theirs[j]) for k in open_mine)
+                open_theirs.append(theirs[j])
+                j += 1
+
+        # Same order as comparing each appointment in this agenda
+        # with each appointment in the other, in list order
+        pairs.sort()
         default_desc = (desc == "")
         result = Agenda()
-        for thisappt in self.appts:
-            if default_desc: 
+        for i, j in pairs:
+            thisappt = self.appts[i]
+            if default_desc:
                 desc = thisappt.desc
-            for otherappt in other.appts:
-                if thisappt.overlaps(otherappt):
-                    result.append(thisappt.intersect(otherappt,desc))
-        
+            result.append(thisappt.intersect(other.appts[j], desc))
+        return result
+
+    @classmethod
+    def intersect_all(cls, agendas, desc=""):
+        """Return a new agenda containing the times that are within
+        an appointment of every one of the agendas: the common free
+        time of N people, found in one sweep rather than N-1
+        pairwise intersections.
+
+        Gives the same blocks of time as intersecting the normalized
+        agendas one after another.  Titles are taken from the first
+        agenda, unless they are overridden with the "desc" argument.
+
+        Arguments:
+           agendas: A non-empty list of Agendas
+           desc:  If provided, this string becomes the title of
+                all the appointments in the result.
+        Raises:
+           ValueError if agendas is empty
+        """
+        if not agendas:
+            raise ValueError("Need at least one agenda to intersect")
+        return cls.intersect_quorum(agendas, len(agendas), desc)
+
+    @classmethod
+    def intersect_quorum(cls, agendas, quorum, desc=""):
+        """Return a new agenda containing the times that are within
+        an appointment of at least quorum of the agendas, in order
+        and with no overlaps.
+
+        The agendas are normalized and their begin and end times
+        merged with a heap, so the cost is O(total log N) for N
+        agendas with total appointments.  An appointment ending at
+        the same time another begins splits the result there when
+        the count would drop below quorum, just as normalize keeps
+        appointments that only touch apart.  Titles are taken from
+        the first agenda (in list order) that is free when each
+        block starts, unless they are overridden with "desc".
+
+        Arguments:
+           agendas: A list of Agendas
+           quorum:  How many of the agendas must be free, at least 1
+           desc:  If provided, this string becomes the title of
+                all the appointments in the result.
+        """
+        if quorum < 1:
+            raise ValueError("Quorum must be at least 1")
+        # Ends sort before begins at the same minute
+        END, BEGIN = 0, 1
+        def events(k, ag):
+            for appt in ag.normalized().appts:
+                yield (appt.begin_minute, BEGIN, k, appt)
+                yield (appt.end_minute, END, k, appt)
+        streams = [events(k, ag) for k, ag in enumerate(agendas)]
+
+        result = cls()
+        active = [None] * len(agendas)
+        # Indexes of agendas that may be free, lowest first, for the
+        # title.  Agendas that have since ended are dropped when they
+        # reach the top; one that begins again while still in the
+        # heap is not added twice, so it holds at most N entries.
+        lowest = [ ]
+        in_heap = [False] * len(agendas)
+        count = 0
+        start = None
+        first = None
+        for minute, kind, k, appt in heapq.merge(*streams):
+            if kind == BEGIN:
+                active[k] = appt
+                count += 1
+                if not in_heap[k]:
+                    heapq.heappush(lowest, k)
+                    in_heap[k] = True
+                if count == quorum:
+                    start = minute
+                    while active[lowest[0]] is None:
+                        in_heap[heapq.heappop(lowest)] = False
+                    first = active[lowest[0]]
+            else:
+                if count == quorum and start < minute:
+                    result.append(Appt.from_minutes(start, minute,
+                        desc or first.desc, first.tzinfo))
+                active[k] = None
+                count -= 1
         return result
 
     def normalize(self):
@@ -247,7 +968,7 @@ class Agenda:
         if len(self.appts) == 0:
             return
 
-        ordering = lambda ap: ap.begin
+        ordering = lambda ap: ap.begin_minute
         self.appts.sort(key=ordering)
 
         normalized = [ ]
@@ -268,6 +989,7 @@ class Agenda:
         # print("Last appt: ", cur)
         normalized.append(cur)
         self.appts = normalized
+        self._index = None
 
     def normalized(self):
         """
@@ -280,6 +1002,22 @@ class Agenda:
         copy.normalize()
         return copy
         
+    def localized(self, tzinfo):
+        """A new agenda of the same class with the appointments of
+        this one, their naive (wall-clock) times taken as local
+        times in tzinfo.  So agendas made in different time zones
+        can be compared.  Appointments that already have a tzinfo
+        are kept as they are.
+        """
+        result = type(self)()
+        for appt in self.appts:
+            if appt.tzinfo is None:
+                appt = Appt.from_minutes(to_minutes(appt.begin.replace(tzinfo=tzinfo)),
+                                         to_minutes(appt.end.replace(tzinfo=tzinfo)),
+                                         appt.desc, tzinfo)
+            result.append(appt)
+        return result
+
     def complement(self, freeAgenda):
         """Produce the complement of an agenda
         within the span of a timeblock represented by 
@@ -298,30 +1036,109 @@ class Agenda:
            description of the resulting appointments comes
            from freeblock.desc.
         """
-        copy = self.normalized()
         comp = Agenda()
+        comp.appts.extend(self.free_times(freeAgenda))
+        return comp
+
+    def clip(self, freeAgenda):
+        """The parts of the appointments in this agenda that lie
+        within the appointments of freeAgenda, with the descriptions
+        of this agenda's appointments.  An appointment that spans
+        several freeblocks, like a conference over several days,
+        has a part in each.
+
+        freeAgenda must be in order with no overlaps (as normalize
+        leaves it); this agenda need not be.  The first freeblock of
+        each appointment is found by binary search, so a long
+        appointment costs only the freeblocks it covers, not the
+        days it spans.
+        """
+        blocks = freeAgenda.appts
+        ends = [block.end_minute for block in blocks]
+        result = Agenda()
+        for appt in self.appts:
+            i = bisect.bisect_right(ends, appt.begin_minute)
+            while i < len(blocks) and blocks[i].begin_minute < appt.end_minute:
+                result.append(Appt.from_minutes(max(appt.begin_minute, blocks[i].begin_minute),
+                                                min(appt.end_minute, blocks[i].end_minute),
+                                                appt.desc, appt.tzinfo))
+                i += 1
+        return result
+
+    def free_times(self, freeAgenda):
+        """Generator version of complement: yields the appointments
+        of self.complement(freeAgenda) one at a time, in the same
+        order, without building the whole complement.
+        """
+        copy = self.normalized()
+        # A normalized agenda is sorted with no overlaps, so the end
+        # times are sorted too and we can bisect for the first
+        # appointment that is not over before a freeblock begins.
+        ends = [appt.end_minute for appt in copy.appts]
+        cursor = 0
+        prev_begin = None
         for freeblock in freeAgenda:
-            day = freeblock.begin.date()
             desc = freeblock.desc
-            cur_time = freeblock.begin
-            for appt in copy.appts:
-                if appt < freeblock:
-                    continue
+            tzinfo = freeblock.tzinfo
+            cur_time = freeblock.begin_minute
+            # Freeblocks usually come in order (one per day), so
+            # we only need to search forward from the last one.
+            if prev_begin is None or freeblock.begin_minute < prev_begin:
+                cursor = 0
+            cursor = bisect.bisect_right(ends, freeblock.begin_minute, cursor)
+            prev_begin = freeblock.begin_minute
+            for i in range(cursor, len(copy.appts)):
+                appt = copy.appts[i]
                 if appt > freeblock:
-                    if cur_time < freeblock.end:
-                        comp.append(Appt(day,cur_time.time(),freeblock.end.time(), desc))
-                        cur_time = freeblock.end
                     break
-                if cur_time < appt.begin:
-                    # print("Creating free time from", cur_time, "to", appt.begin)
-                    comp.append(Appt(day, cur_time.time(), appt.begin.time(), desc))
-                cur_time = max(appt.end,cur_time)
-            if cur_time < freeblock.end:
-                # print("Creating final free time from", cur_time, "to", freeblock.end)
-                comp.append(Appt(day, cur_time.time(), freeblock.end.time(), desc))
-        return comp
+                if cur_time < appt.begin_minute:
+                    yield Appt.from_minutes(cur_time, appt.begin_minute, desc, tzinfo)
+                cur_time = max(appt.end_minute,cur_time)
+            if cur_time < freeblock.end_minute:
+                yield Appt.from_minutes(cur_time, freeblock.end_minute, desc, tzinfo)
 
+    def slots(self, freeAgenda, duration, granularity=None):
+        """Generator of meeting slots: appointments of the given
+        duration within freeAgenda that do not conflict with this
+        agenda, in the order of the free times they fall in.
 
+        Arguments:
+           freeAgenda: The periods to look for slots in, as for
+               complement.  In time order, slots come out earliest first.
+           duration: A datetime.timedelta, how long the meeting is.
+           granularity: (optional) A datetime.timedelta.  If given,
+               slots start on multiples of it (e.g., on the quarter
+               hour) and one begins every granularity; otherwise
+               slots are back to back from the start of each free time.
+        Yields:
+           Appts of length duration, described as the freeblock
+           they fall in.
+        """
+        length = duration // MINUTE
+        if length <= 0:
+            raise ValueError("Slot duration must be at least a minute")
+        step = length
+        if granularity is not None:
+            step = granularity // MINUTE
+            if step <= 0:
+                raise ValueError("Slot granularity must be at least a minute")
+        for free in self.free_times(freeAgenda):
+            begin = free.begin_minute
+            if granularity is not None:
+                begin = -(-begin // step) * step
+            while begin + length <= free.end_minute:
+                yield Appt.from_minutes(begin, begin + length, free.desc, free.tzinfo)
+                begin += step
+
+    def earliest_slots(self, freeAgenda, duration, k=1, granularity=None):
+        """Return a new agenda of the first k slots from
+        self.slots(freeAgenda, duration, granularity), stopping
+        as soon as they are found.
+        """
+        result = Agenda()
+        result.appts.extend(itertools.islice(
+            self.slots(freeAgenda, duration, granularity), k))
+        return result
 
     def __len__(self):
         """Number of appointments, callable as built-in len() function"""
@@ -333,10 +1150,72 @@ class Agenda:
 
     def __str__(self):
         """String representation of a whole agenda"""
-        rep = ""
+        return self.dumps()
+
+    def lines(self):
+        """Generator: str(appt) for each appointment, in order.
+
+        Appointments are formatted from their minutes, with the date
+        text cached for each day and the clock times looked up in a
+        table, rather than three strftime calls each.  Times with a
+        tzinfo are shifted to local time by their UTC offset, found
+        once for each time zone and day.
+        """
+        days = { }
+        def day_text(day):
+            text = days.get(day)
+            if text is None:
+                text = datetime.date.fromordinal(EPOCH_ORDINAL + day).strftime("%Y.%m.%d ")
+                days[day] = text
+            return text
+        offsets = { }
+        def local(minute, tzinfo):
+            # The UTC offset changes at most once a day, so if it is
+            # the same at both ends of a (UTC) day it holds all day.
+            # Some tzinfo classes (like dateutil's) can't be hashed.
+            day = minute // (24 * 60) * (24 * 60)
+            key = (id(tzinfo), day)
+            offset = offsets.get(key)
+            if offset is None:
+                first = from_minutes(day, tzinfo).utcoffset() // MINUTE
+                last = from_minutes(day + 24 * 60 - 1, tzinfo).utcoffset() // MINUTE
+                offset = first if first == last else False
+                offsets[key] = offset
+            if offset is False:
+                offset = from_minutes(minute, tzinfo).utcoffset() // MINUTE
+            return minute + offset
         for appt in self.appts:
-            rep += str(appt) + "\n"
-        return rep[:-1]
+            begin = appt.begin_minute
+            end = appt.end_minute
+            if appt.tzinfo is not None:
+                begin = local(begin, appt.tzinfo)
+                end = local(end, appt.tzinfo)
+            day, begin = divmod(begin, 24 * 60)
+            end_day, end = divmod(end, 24 * 60)
+            endstr = CLOCK[end] + " | "
+            if end_day != day:
+                endstr = day_text(end_day) + endstr
+            yield day_text(day) + CLOCK[begin] + " " + endstr + appt.desc
+
+    def dumps(self):
+        """The whole agenda as text, one appointment per line
+        (the same as str(agenda)).
+        """
+        return "\n".join(self.lines())
+
+    def write(self, f):
+        """Write the agenda to a file object, one appointment
+        per line, without building the whole text first.
+        """
+        for line in self.lines():
+            f.write(line + "\n")
+
+    @classmethod
+    def loads(cls, text, errors=None):
+        """Factory: Read an agenda from text, as written by
+        dumps or write (see from_file for errors).
+        """
+        return cls.from_file(text.splitlines(), errors)
 
     def __eq__(self,other):
         """Equality, ignoring descriptions --- just equal blocks of time"""
@@ -345,12 +1224,62 @@ class Agenda:
         for i in range(len(self.appts)):
             mine = self.appts[i]
             theirs = other.appts[i]
-            if not (mine.begin == theirs.begin and
-                    mine.end == theirs.end):
+            if not (mine.begin_minute == theirs.begin_minute and
+                    mine.end_minute == theirs.end_minute):
                 return False
         return True
 
 
+class NormalizedAgenda(Agenda):
+    """An Agenda that is always normalized: appointments are kept
+    in order by begin time and merged with any they overlap as
+    they are appended, so normalize has nothing left to do and
+    complement can skip it.  Appending costs a bisect and a merge
+    with the neighbouring appointments, not a re-sort of the whole
+    agenda.  Change it only through append.
+    """
+
+    def __init__(self):
+        """An empty agenda."""
+        super().__init__()
+        # Parallel to self.appts; both are sorted because the
+        # appointments do not overlap.
+        self._begins = [ ]
+        self._ends = [ ]
+
+    def append(self, appt):
+        """Add an Appt to the agenda, merging it with any
+        appointments it overlaps as normalize would.
+        """
+        # Appointments i .. j-1 overlap the new one
+        i = bisect.bisect_right(self._ends, appt.begin_minute)
+        j = bisect.bisect_left(self._begins, appt.end_minute, i)
+        merged = appt
+        if i < j:
+            parts = self.appts[i:j]
+            parts.insert(bisect.bisect_right(self._begins, appt.begin_minute, i, j) - i,
+                         appt)
+            merged = Appt.from_minutes(parts[0].begin_minute,
+                                       max(appt.end_minute, self._ends[j - 1]),
+                                       " ".join(part.desc for part in parts),
+                                       parts[0].tzinfo)
+        if self._index is not None:
+            for part in self.appts[i:j]:
+                self._index.remove(part)
+            self._index.insert(merged)
+        self.appts[i:j] = [merged]
+        self._begins[i:j] = [merged.begin_minute]
+        self._ends[i:j] = [merged.end_minute]
+
+    def normalize(self):
+        """Already normalized; nothing to do."""
+        return
+
+    def normalized(self):
+        """This agenda, which is already normalized."""
+        return self
+
+
 #########################
 #  Self-test invoked when module is run
 #  as main program. 
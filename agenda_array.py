@@ -0,0 +1,230 @@
+"""An AgendaArray is a columnar agenda, for agendas with
+   thousands of appointments.
+
+   Instead of a list of Appt objects, an AgendaArray keeps
+   parallel NumPy arrays of begin and end times (int64 minutes
+   since the epoch, as in agenda.Appt) and a label for each
+   appointment.  Labels index a table of (description, tzinfo)
+   pairs, so a description shared by many appointments (like
+   "free time") is stored once.
+
+   normalize, intersect and complement work on whole arrays at
+   once and give the same appointments, in the same order, as
+   the methods of the same name in agenda.Agenda.  Convert with
+   AgendaArray.from_agenda and to_agenda.
+"""
+
+import numpy as np
+
+import agenda
+
+class AgendaArray:
+    """Appointments as parallel arrays of begin, end and label."""
+
+    def __init__(self, begins=(), ends=(), labels=(), table=()):
+        """An agenda with appointment i from begins[i] to ends[i]
+        (minutes since the epoch), with description and tzinfo
+        table[labels[i]].  With no arguments, an empty agenda.
+        """
+        self.begins = np.array(begins, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.labels = np.array(labels, dtype=np.int64)
+        self.table = list(table)
+        self._codes = { }
+        for code, (desc, tzinfo) in enumerate(self.table):
+            self._codes.setdefault((desc, id(tzinfo)), code)
+
+    @classmethod
+    def from_agenda(cls, ag):
+        """Factory: a columnar copy of an agenda.Agenda."""
+        result = cls()
+        n = len(ag.appts)
+        result.begins = np.fromiter((appt.begin_minute for appt in ag.appts),
+                                    dtype=np.int64, count=n)
+        result.ends = np.fromiter((appt.end_minute for appt in ag.appts),
+                                  dtype=np.int64, count=n)
+        result.labels = np.fromiter(
+            (result._label(appt.desc, appt.tzinfo) for appt in ag.appts),
+            dtype=np.int64, count=n)
+        return result
+
+    def to_agenda(self):
+        """An agenda.Agenda with the same appointments."""
+        result = agenda.Agenda()
+        table = self.table
+        for begin, end, label in zip(self.begins.tolist(), self.ends.tolist(),
+                                     self.labels.tolist()):
+            desc, tzinfo = table[label]
+            result.append(agenda.Appt.from_minutes(begin, end, desc, tzinfo))
+        return result
+
+    def _label(self, desc, tzinfo):
+        """The label for (desc, tzinfo), adding it to the table
+        if it is not there yet.
+        """
+        # By identity, as some tzinfo classes (like dateutil's) can't
+        # be hashed; the table keeps each tzinfo alive.
+        key = (desc, id(tzinfo))
+        code = self._codes.get(key)
+        if code is None:
+            code = len(self.table)
+            self.table.append((desc, tzinfo))
+            self._codes[key] = code
+        return code
+
+    def _select(self, begins, ends, labels):
+        """A new AgendaArray sharing this one's label table (not a
+        copy: labels are only ever added to it, so each agenda's
+        labels stay valid).
+        """
+        result = AgendaArray.__new__(AgendaArray)
+        result.begins = begins
+        result.ends = ends
+        result.labels = labels
+        result.table = self.table
+        result._codes = self._codes
+        return result
+
+    def normalize(self):
+        """Merge overlapping appointments, as Agenda.normalize does.
+        Afterward the appointments are in order by begin time with
+        no overlaps.  Merged appointments get the descriptions of
+        their parts joined by blanks.
+        """
+        if len(self.begins) == 0:
+            return
+        # A stable sort, like list.sort in Agenda.normalize
+        order, first, last, reach = _runs(self.begins, self.ends, "mergesort")
+        labels = self.labels[order]
+        merged_labels = labels[first]
+        # Only merged groups need a new description, made with
+        # plain lists as there is one join for each.
+        groups = np.flatnonzero(last > first)
+        if len(groups):
+            parts = labels.tolist()
+            table = self.table
+            merged_labels[groups] = [
+                self._label(" ".join([table[k][0] for k in parts[i:j + 1]]),
+                            table[parts[i]][1])
+                for i, j in zip(first[groups].tolist(), last[groups].tolist())]
+        self.begins = self.begins[order[first]]
+        self.ends = reach[last]
+        self.labels = merged_labels
+
+    def normalized(self):
+        """A normalized copy of this agenda."""
+        copy = self._select(self.begins, self.ends, self.labels)
+        copy.normalize()
+        return copy
+
+    def intersect(self, other, desc=""):
+        """Overlaps between appointments in this agenda and
+        appointments in other, in the same order and with the same
+        descriptions as Agenda.intersect.
+
+        Arguments:
+           other: Another AgendaArray, to be intersected with this one
+           desc:  If provided, this string becomes the title of
+                all the appointments in the result.
+        """
+        # Each overlapping pair is found exactly once, from whichever
+        # of the two begins later (or from mine, if they begin
+        # together): it begins within the other.  So the pairs cost
+        # only the overlaps, however long some appointments are.
+        order = np.argsort(other.begins, kind="mergesort")
+        other_begins = other.begins[order]
+        lo = np.searchsorted(other_begins, self.begins, side="left")
+        hi = np.searchsorted(other_begins, self.ends, side="left")
+        mine_a, theirs_a = _expand(lo, np.maximum(hi, lo))
+        my_order = np.argsort(self.begins, kind="mergesort")
+        my_begins = self.begins[my_order]
+        lo = np.searchsorted(my_begins, other.begins, side="right")
+        hi = np.searchsorted(my_begins, other.ends, side="left")
+        theirs_b, mine_b = _expand(lo, np.maximum(hi, lo))
+        mine = np.concatenate((mine_a, my_order[mine_b]))
+        theirs = np.concatenate((order[theirs_a], theirs_b))
+        # Order of the nested loop in Agenda.intersect
+        pairs = np.lexsort((theirs, mine))
+        mine = mine[pairs]
+        theirs = theirs[pairs]
+        result = self._select(np.maximum(self.begins[mine], other.begins[theirs]),
+                              np.minimum(self.ends[mine], other.ends[theirs]),
+                              self.labels[mine])
+        if desc != "":
+            codes = np.unique(result.labels)
+            relabel = np.empty(len(self.table), dtype=np.int64)
+            for code in codes.tolist():
+                relabel[code] = result._label(desc, self.table[code][1])
+            result.labels = relabel[result.labels]
+        return result
+
+    def complement(self, freeArray):
+        """The times within appointments of freeArray that are not
+        within appointments of this agenda, as Agenda.complement.
+        Descriptions come from the freeArray appointments.
+        """
+        # Only the times of the merged appointments are needed, not
+        # their descriptions.
+        order, first, last, reach = _runs(self.begins, self.ends)
+        busy_begins = self.begins[order[first]]
+        busy_ends = reach[last]
+        begins = np.append(busy_begins, 0)
+        ends = np.append(busy_ends, 0)
+        free_begins = freeArray.begins
+        free_ends = freeArray.ends
+        n = len(busy_begins)
+        # Appointments lo .. hi-1 touch each freeblock, leaving
+        # (hi - lo + 1) possible gaps: before each of them and
+        # after the last.
+        lo = np.searchsorted(busy_ends, free_begins, side="right")
+        hi = np.maximum(np.searchsorted(busy_begins, free_ends, side="left"), lo)
+        block, appt = _expand(lo, hi + 1)
+        first_gap = appt == lo[block]
+        last_gap = appt == hi[block]
+        gap_begins = np.where(first_gap, free_begins[block],
+                              np.maximum(ends[np.maximum(appt - 1, 0)],
+                                         free_begins[block]))
+        gap_ends = np.where(last_gap, free_ends[block],
+                            begins[np.minimum(appt, n)])
+        keep = gap_begins < gap_ends
+        return freeArray._select(gap_begins[keep], gap_ends[keep],
+                                 freeArray.labels[block[keep]])
+
+    def __len__(self):
+        """Number of appointments"""
+        return len(self.begins)
+
+    def __eq__(self, other):
+        """Equality, ignoring descriptions --- just equal blocks of time"""
+        return (np.array_equal(self.begins, other.begins) and
+                np.array_equal(self.ends, other.ends))
+
+
+def _runs(begins, ends, kind="quicksort"):
+    """Groups of overlapping appointments, as normalize merges them.
+    Returns (order, first, last, reach): order sorts the appointments
+    by begin; in that order, each group runs from index first[g] to
+    last[g], and reach[i] is the latest end of appointments 0 .. i,
+    so reach[last[g]] is the end of group g.
+    """
+    order = np.argsort(begins, kind=kind)
+    begins = begins[order]
+    reach = np.maximum.accumulate(ends[order])
+    # An appointment starts a new group when it begins at or
+    # after the latest end of everything before it.
+    starts = np.ones(len(begins), dtype=bool)
+    starts[1:] = begins[1:] >= reach[:-1]
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(begins)) - 1
+    return order, first, last, reach
+
+
+def _expand(lo, hi):
+    """All pairs (k, j) with lo[k] <= j < hi[k], as two arrays,
+    in order of k and then j.
+    """
+    counts = hi - lo
+    owner = np.repeat(np.arange(len(lo)), counts)
+    starts = np.cumsum(counts) - counts
+    index = np.arange(counts.sum()) - np.repeat(starts, counts) + lo[owner]
+    return owner, index
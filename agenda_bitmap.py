@@ -0,0 +1,185 @@
+"""An AgendaBitmap is an agenda rasterized onto a fixed grid of
+   time slots, for scheduling with many people on a regular grid
+   (like every 15 minutes).
+
+   A bitmap covers a window of time, from begin to end, divided
+   into slots of one granularity.  Each slot is one bit: 1 if it
+   is free (within an appointment of the agenda), 0 if not.  The
+   bits are packed eight to a byte in a NumPy array, so a quarter
+   of a year at 15 minutes is about a kilobyte.
+
+   Bitmaps over the same window and granularity combine a byte at
+   a time: intersecting N people's free times is N-1 bitwise ANDs
+   (intersect_all), and the slots where at least K of them are free
+   come from counting the bits of each slot (intersect_quorum).
+   to_agenda turns a bitmap back into an agenda.Agenda of Appts,
+   one for each run of free slots.
+
+   Times are rounded to the grid: a slot is free only if an
+   appointment covers all of it (or, with partial=True, any of it,
+   as suits busy times).
+"""
+
+import datetime
+
+import numpy as np
+
+import agenda
+
+class AgendaBitmap:
+    """Free slots of a window of time, as packed bits."""
+
+    def __init__(self, begin, granularity, length, bits=None, tzinfo=None):
+        """A bitmap of length slots, each granularity minutes,
+        the first starting begin minutes since the epoch (see
+        agenda.to_minutes), in time zone tzinfo.  bits are the
+        packed slots (np.packbits); with none, no slot is free.
+        """
+        self.begin = begin
+        self.granularity = granularity
+        self.length = length
+        self.tzinfo = tzinfo
+        if bits is None:
+            bits = np.zeros((length + 7) // 8, dtype=np.uint8)
+        self.bits = bits
+
+    @classmethod
+    def from_agenda(cls, ag, begin, end, granularity=datetime.timedelta(minutes=15),
+                    partial=False):
+        """Factory: The slots of an agenda.Agenda within a window.
+
+        Arguments:
+            ag: An agenda.Agenda (of free times)
+            begin, end: datetime.datetime objects, the window.
+               Appointments outside it are ignored.
+            granularity: A datetime.timedelta of whole minutes,
+               the length of each slot.  The window is cut short to
+               a whole number of slots.
+            partial: If True, a slot is set if an appointment covers
+               any of it, rather than all of it.
+        Raises:
+            ValueError if granularity is not a positive number of
+            minutes, or the window ends before it begins
+        """
+        step = _minutes(granularity)
+        first = agenda.to_minutes(begin)
+        length = (agenda.to_minutes(end) - first) // step
+        if length < 0:
+            raise ValueError("Window must end after it begins")
+        n = len(ag.appts)
+        begins = np.fromiter((appt.begin_minute for appt in ag.appts),
+                             dtype=np.int64, count=n) - first
+        ends = np.fromiter((appt.end_minute for appt in ag.appts),
+                           dtype=np.int64, count=n) - first
+        if partial:
+            lo = begins // step
+            hi = -(-ends // step)
+        else:
+            lo = -(-begins // step)
+            hi = ends // step
+        lo = np.clip(lo, 0, length)
+        hi = np.clip(hi, 0, length)
+        keep = lo < hi
+        # +1 where each appointment's slots start and -1 after they
+        # end; a slot is set where the running total is positive.
+        edges = (np.bincount(lo[keep], minlength=length + 1) -
+                 np.bincount(hi[keep], minlength=length + 1))
+        slots = np.cumsum(edges[:length]) > 0
+        return cls(first, step, length, np.packbits(slots), begin.tzinfo)
+
+    def to_agenda(self, desc="free time"):
+        """An agenda.Agenda with an Appt for each run of set slots,
+        in order, titled desc.
+        """
+        slots = np.zeros(self.length + 2, dtype=np.int8)
+        slots[1:-1] = self.slots()
+        change = np.diff(slots)
+        starts = np.flatnonzero(change == 1)
+        ends = np.flatnonzero(change == -1)
+        result = agenda.Agenda()
+        step = self.granularity
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            result.append(agenda.Appt.from_minutes(self.begin + start * step,
+                                                   self.begin + end * step,
+                                                   desc, self.tzinfo))
+        return result
+
+    def slots(self):
+        """The slots unpacked, as an array of bools"""
+        return np.unpackbits(self.bits)[:self.length].astype(bool)
+
+    def count(self):
+        """Number of set slots"""
+        return int(np.unpackbits(self.bits)[:self.length].sum())
+
+    def _like(self, bits):
+        """A new bitmap over the same window as this one."""
+        return AgendaBitmap(self.begin, self.granularity, self.length, bits, self.tzinfo)
+
+    def _check(self, other):
+        if (self.begin, self.granularity, self.length) != \
+                (other.begin, other.granularity, other.length):
+            raise ValueError("Bitmaps must have the same window and granularity")
+
+    def __and__(self, other):
+        """Slots set in both bitmaps"""
+        self._check(other)
+        return self._like(self.bits & other.bits)
+
+    def __or__(self, other):
+        """Slots set in either bitmap"""
+        self._check(other)
+        return self._like(self.bits | other.bits)
+
+    def __invert__(self):
+        """Slots not set, as from busy times to free times"""
+        bits = np.packbits(~self.slots())
+        return self._like(bits)
+
+    @classmethod
+    def intersect_all(cls, bitmaps):
+        """The slots set in every one of bitmaps (a non-empty list
+        of bitmaps over the same window), like
+        agenda.Agenda.intersect_all.
+        """
+        for bitmap in bitmaps[1:]:
+            bitmaps[0]._check(bitmap)
+        bits = np.bitwise_and.reduce([bitmap.bits for bitmap in bitmaps])
+        return bitmaps[0]._like(bits)
+
+    @classmethod
+    def counts(cls, bitmaps):
+        """For each slot, how many of bitmaps (a non-empty list of
+        bitmaps over the same window) have it set.
+        """
+        for bitmap in bitmaps[1:]:
+            bitmaps[0]._check(bitmap)
+        rows = np.unpackbits(np.vstack([bitmap.bits for bitmap in bitmaps]), axis=1)
+        return rows[:, :bitmaps[0].length].sum(axis=0)
+
+    @classmethod
+    def intersect_quorum(cls, bitmaps, quorum):
+        """The slots set in at least quorum of bitmaps, like
+        agenda.Agenda.intersect_quorum.
+        """
+        if quorum < 1:
+            raise ValueError("Quorum must be at least 1")
+        return bitmaps[0]._like(np.packbits(cls.counts(bitmaps) >= quorum))
+
+    def __len__(self):
+        """Number of slots"""
+        return self.length
+
+    def __eq__(self, other):
+        """Same window, granularity and set slots"""
+        return ((self.begin, self.granularity, self.length) ==
+                (other.begin, other.granularity, other.length) and
+                np.array_equal(self.bits, other.bits))
+
+
+def _minutes(granularity):
+    """A timedelta as a positive whole number of minutes"""
+    minutes, rest = divmod(granularity, agenda.MINUTE)
+    if minutes < 1 or rest:
+        raise ValueError("Granularity must be a positive whole number of minutes")
+    return minutes
@@ -0,0 +1,240 @@
+"""
+Timing comparisons for the agenda code.
+
+Run as 'python3 benchmark.py' (or 'make bench') to print
+seconds per operation for each benchmark below.
+"""
+
+import datetime
+import random
+import time
+
+import agenda
+
+def timed(fn, *args, repeat=3):
+    """Best wall-clock time of repeat calls of fn(*args), in seconds."""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, seconds, per=None):
+    """Print one timing line."""
+    if per:
+        print("{:<44} {:10.4f} s  {:10.2f} us each".format(
+            name, seconds, seconds / per * 1e6))
+    else:
+        print("{:<44} {:10.4f} s".format(name, seconds))
+
+def make_agenda(n, per_day=10, desc="appt", seed=210):
+    """A random agenda of n short appointments, about per_day
+    of them on each day between 8:00 and 18:00.
+    """
+    rand = random.Random(seed)
+    first = datetime.date(2016, 1, 1)
+    result = agenda.Agenda()
+    for i in range(n):
+        day = first + datetime.timedelta(days=i // per_day)
+        begin = rand.randrange(8 * 60, 17 * 60, 15)
+        end = begin + rand.randrange(15, 61, 15)
+        result.append(agenda.Appt(day,
+            datetime.time(begin // 60, begin % 60),
+            datetime.time(end // 60, end % 60),
+            "{} {}".format(desc, i)))
+    return result
+
+def make_freeblocks(days, begin=9, end=17):
+    """One freeblock per day, as chooseCal builds them."""
+    first = datetime.date(2016, 1, 1)
+    result = agenda.Agenda()
+    for i in range(days):
+        result.append(agenda.Appt(first + datetime.timedelta(days=i),
+            datetime.time(begin), datetime.time(end), "free time"))
+    return result
+
+def copy_of(ag):
+    """A copy of an agenda, since normalize works in place."""
+    result = agenda.Agenda()
+    result.appts = list(ag.appts)
+    return result
+
+def bench_agenda_array(sizes=(10000, 100000)):
+    """Agenda vs. the NumPy AgendaArray for normalize,
+    intersect and complement.
+    """
+    import agenda_array
+    for n in sizes:
+        mine = make_agenda(n, seed=1)
+        theirs = make_agenda(n, seed=2)
+        free = make_freeblocks(n // 10)
+        mine_arr = agenda_array.AgendaArray.from_agenda(mine)
+        theirs_arr = agenda_array.AgendaArray.from_agenda(theirs)
+        free_arr = agenda_array.AgendaArray.from_agenda(free)
+        report("Agenda.normalize, n={}".format(n),
+               timed(lambda: copy_of(mine).normalize()))
+        report("AgendaArray.normalize, n={}".format(n),
+               timed(mine_arr.normalized))
+        report("Agenda.intersect, n={}".format(n),
+               timed(mine.intersect, theirs))
+        report("AgendaArray.intersect, n={}".format(n),
+               timed(mine_arr.intersect, theirs_arr))
+        report("Agenda.complement, n={}".format(n),
+               timed(lambda: copy_of(mine).complement(free)))
+        report("AgendaArray.complement, n={}".format(n),
+               timed(mine_arr.complement, free_arr))
+        report("AgendaArray.from_agenda, n={}".format(n),
+               timed(agenda_array.AgendaArray.from_agenda, mine))
+        report("AgendaArray.to_agenda, n={}".format(n),
+               timed(mine_arr.to_agenda))
+
+def bench_parse(n=100000):
+    """Lines per second for the strict Appt parser, the fast
+    path of Appt.from_string, and the bulk Appt.from_strings.
+    """
+    lines = str(make_agenda(n)).splitlines()
+    strict = agenda.Appt.from_string_strict
+    fast = agenda.Appt.from_string
+    for name, fn in [("Appt.from_string_strict", lambda: [strict(line) for line in lines]),
+                     ("Appt.from_string", lambda: [fast(line) for line in lines]),
+                     ("Appt.from_strings", lambda: agenda.Appt.from_strings(lines))]:
+        seconds = timed(fn)
+        report("{}, n={}".format(name, n), seconds, n)
+        print("{:<44} {:10.0f} lines/s".format("", n / seconds))
+
+def old_agenda_str(ag):
+    """Agenda.__str__ as it was: repeated string concatenation."""
+    rep = ""
+    for appt in ag.appts:
+        rep += str(appt) + "\n"
+    return rep[:-1]
+
+def old_agenda_load(text):
+    """Reading an agenda with the field-by-field parser."""
+    result = agenda.Agenda()
+    for line in text.splitlines():
+        result.append(agenda.Appt.from_string_strict(line))
+    return result
+
+def bench_serialize(n=100000):
+    """Round trip of an agenda through text: the old __str__ and
+    parser against Agenda.dumps and Agenda.loads.
+    """
+    ag = make_agenda(n)
+    text = ag.dumps()
+    report("old Agenda.__str__, n={}".format(n), timed(old_agenda_str, ag), n)
+    report("Agenda.dumps, n={}".format(n), timed(ag.dumps), n)
+    report("old parse, n={}".format(n), timed(old_agenda_load, text), n)
+    report("Agenda.loads, n={}".format(n), timed(agenda.Agenda.loads, text), n)
+    report("old round trip, n={}".format(n),
+           timed(lambda: old_agenda_load(old_agenda_str(ag))), n)
+    report("dumps/loads round trip, n={}".format(n),
+           timed(lambda: agenda.Agenda.loads(ag.dumps())), n)
+
+def make_events(n, per_day=10, seed=210):
+    """n calendar events as fetch_events returns them, with
+    RFC 3339 start and end times.
+    """
+    events = []
+    for appt in make_agenda(n, per_day, "event", seed):
+        begin = appt.begin
+        end = appt.end
+        events.append({"summary": appt.desc,
+                       "start_time": begin.strftime("%Y-%m-%dT%H:%M:00-08:00"),
+                       "end_time": end.strftime("%Y-%m-%dT%H:%M:00-08:00")})
+    return events
+
+def old_event_appts(events, begin_time, end_time):
+    """The event loop of chooseCal as it was, parsing each
+    timestamp with arrow up to five times.
+    """
+    import arrow
+    result = agenda.Agenda()
+    for e in events:
+        if not (arrow.get(e['end_time']).timetz() < begin_time or arrow.get(e['start_time']).timetz() > end_time):
+            appt = agenda.Appt(arrow.get(e["start_time"]).datetime.date(), arrow.get(e["start_time"]).datetime.timetz(), arrow.get(e["end_time"]).datetime.timetz(), e["summary"])
+            result.append(appt)
+    return result
+
+def bench_events(n=10000):
+    """Calendar events to Appts, as chooseCal does: the old
+    arrow loop against Agenda.from_events.
+    """
+    events = make_events(n)
+    pacific = datetime.timezone(datetime.timedelta(hours=-8))
+    begin_time = datetime.time(10, tzinfo=pacific)
+    end_time = datetime.time(16, tzinfo=pacific)
+    report("old chooseCal loop, n={}".format(n),
+           timed(old_event_appts, events, begin_time, end_time), n)
+    report("Agenda.from_events, n={}".format(n),
+           timed(agenda.Agenda.from_events, events, begin_time, end_time), n)
+
+def in_zone(ag, tzinfo):
+    """A copy of an agenda with every Appt in time zone tzinfo
+    (its minutes taken as UTC minutes).
+    """
+    result = agenda.Agenda()
+    result.appts = [agenda.Appt.from_minutes(appt.begin_minute, appt.end_minute,
+                                             appt.desc, tzinfo) for appt in ag.appts]
+    return result
+
+def bench_time_zones(n=100000):
+    """Naive agendas against agendas in a time zone with daylight
+    saving time.  The work is on UTC minutes either way; only
+    formatting (lines) converts to local time.
+    """
+    from dateutil import tz
+    pacific = tz.gettz("America/Los_Angeles")
+    mine = make_agenda(n, seed=1)
+    theirs = make_agenda(n, seed=2)
+    free = make_freeblocks(n // 10)
+    zoned = [in_zone(ag, pacific) for ag in (mine, theirs, free)]
+    for name, (mine, theirs, free) in [("naive", (mine, theirs, free)),
+                                        ("America/Los_Angeles", zoned)]:
+        report("intersect, {}, n={}".format(name, n), timed(mine.intersect, theirs), n)
+        report("complement, {}, n={}".format(name, n),
+               timed(lambda: copy_of(mine).complement(free)), n)
+        report("lines, {}, n={}".format(name, n), timed(lambda: list(mine.lines())), n)
+        report("str of each appt, {}, n={}".format(name, n),
+               timed(lambda: [str(appt) for appt in mine]), n)
+
+def bench_agenda_bitmap(people=(10, 100), days=90):
+    """Agenda against AgendaBitmap (15-minute slots) for the
+    common free times of many people over a quarter.
+    """
+    import agenda_bitmap
+    begin = datetime.datetime(2016, 1, 1)
+    end = begin + datetime.timedelta(days=days)
+    for n in people:
+        agendas = [make_agenda(days * 10, seed=k) for k in range(n)]
+        bitmaps = [agenda_bitmap.AgendaBitmap.from_agenda(ag, begin, end) for ag in agendas]
+        report("AgendaBitmap.from_agenda, people={}".format(n),
+               timed(lambda: [agenda_bitmap.AgendaBitmap.from_agenda(ag, begin, end)
+                              for ag in agendas]))
+        report("Agenda.intersect_all, people={}".format(n),
+               timed(agenda.Agenda.intersect_all, agendas))
+        report("AgendaBitmap.intersect_all, people={}".format(n),
+               timed(agenda_bitmap.AgendaBitmap.intersect_all, bitmaps))
+        report("Agenda.intersect_quorum, people={}".format(n),
+               timed(agenda.Agenda.intersect_quorum, agendas, n // 2))
+        report("AgendaBitmap.intersect_quorum, people={}".format(n),
+               timed(agenda_bitmap.AgendaBitmap.intersect_quorum, bitmaps, n // 2))
+        common = agenda_bitmap.AgendaBitmap.intersect_quorum(bitmaps, n // 2)
+        report("AgendaBitmap.to_agenda, people={}".format(n), timed(common.to_agenda))
+
+BENCHMARKS = [
+    bench_agenda_array,
+    bench_parse,
+    bench_serialize,
+    bench_events,
+    bench_time_zones,
+    bench_agenda_bitmap,
+    ]
+
+if __name__ == "__main__":
+    for bench in BENCHMARKS:
+        print("--- {} ---".format(bench.__name__))
+        bench()
@@ -0,0 +1,149 @@
+"""Caches with hit/miss counters, for data we would rather not
+   fetch or compute again on every request.
+
+   LRUCache keeps entries in this process, dropping the least
+   recently used when it is full and any entry older than its
+   time-to-live.  MongoCache keeps entries in a Mongo collection
+   instead, so they are shared by every server process.  Both have
+   the same get / put / delete interface and a stats() method
+   reporting their counters.
+"""
+
+import collections
+import threading
+import time
+
+class LRUCache:
+    """A thread-safe least-recently-used cache with a time-to-live."""
+
+    def __init__(self, max_size=1000, ttl=None, clock=time.time):
+        """A cache of at most max_size entries, each expiring
+        ttl seconds after it was put (never, if ttl is None).
+        clock gives the current time in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """The value for key, or default if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is not None and expires <= self.clock():
+                    del self._entries[key]
+                    self.expirations += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """Store value for key, evicting the least recently
+        used entry if the cache is full.
+        """
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """Remove key, if it is there."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        """Number of entries, including any expired but not yet dropped"""
+        return len(self._entries)
+
+    def stats(self):
+        """Counters for monitoring, as a dict."""
+        lookups = self.hits + self.misses
+        return { "size": len(self._entries),
+                 "max_size": self.max_size,
+                 "hits": self.hits,
+                 "misses": self.misses,
+                 "hit_ratio": self.hits / lookups if lookups else 0.0,
+                 "evictions": self.evictions,
+                 "expirations": self.expirations
+               }
+
+
+class MongoCache:
+    """A cache kept in a Mongo collection, shared between processes.
+
+    Each entry is a document {_id: key, value: value, expires: time}.
+    Keys must be strings and values must be storable in Mongo.
+    Expired entries are dropped when they are next read.  The
+    counters count this process's lookups only.
+    """
+
+    def __init__(self, collection, ttl=None, clock=time.time):
+        """A cache in collection, each entry expiring ttl seconds
+        after it was put (never, if ttl is None).
+        """
+        self.collection = collection
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key, default=None):
+        """The value for key, or default if it is missing or expired."""
+        doc = self.collection.find_one({"_id": key})
+        if doc is not None:
+            if doc.get("expires") is not None and doc["expires"] <= self.clock():
+                self.collection.delete_one({"_id": key, "expires": doc["expires"]})
+                self._count("expirations")
+            else:
+                self._count("hits")
+                return doc["value"]
+        self._count("misses")
+        return default
+
+    def put(self, key, value):
+        """Store value for key."""
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self.collection.replace_one({"_id": key},
+                                    {"_id": key, "value": value, "expires": expires},
+                                    upsert=True)
+
+    def delete(self, key):
+        """Remove key, if it is there."""
+        self.collection.delete_one({"_id": key})
+
+    def clear(self):
+        """Remove every entry."""
+        self.collection.delete_many({})
+
+    def stats(self):
+        """Counters for monitoring, as a dict."""
+        lookups = self.hits + self.misses
+        return { "hits": self.hits,
+                 "misses": self.misses,
+                 "hit_ratio": self.hits / lookups if lookups else 0.0,
+                 "expirations": self.expirations
+               }
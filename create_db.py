@@ -24,6 +24,8 @@ try:
     db.add_user(secrets.client_secrets.db_user,
                 password=secrets.client_secrets.db_user_pw)
     print("Created user {}".format(secrets.client_secrets.db_user))
+    db.dated.create_index("uuid", unique=True)
+    print("Created unique index on uuid")
 except Exception as err:
     print("Failed")
     print(err)
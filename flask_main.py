@@ -7,7 +7,13 @@ from flask import session
 import uuid
 
 import json
+import sys
+import functools
 import logging
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # Date handling 
 import arrow # Replacement for datetime, based on moment.js
@@ -21,6 +27,7 @@ import httplib2   # used in oauth2 flow
 
 # Google API for services 
 from apiclient import discovery
+from apiclient.errors import HttpError
 
 # Mondgo database
 from pymongo import MongoClient
@@ -43,6 +50,8 @@ import secrets.client_secrets # Per-application secrets
 #     We use our own admin_secrets file along with your client_secrets
 #     file on our Raspberry Pis. 
 
+import cache # Caches for events and other per-request data
+import session_store # Sessions kept on the server, not in the cookie
 import agenda # Has all of our class methods for dealing
 # with the overlap of appointments and freetimes.
 
@@ -52,6 +61,17 @@ app.logger.setLevel(logging.DEBUG)
 app.secret_key=CONFIG.secret_key
 
 SCOPES = 'https://www.googleapis.com/auth/calendar.readonly'
+# Calendars are fetched concurrently, by at most FETCH_WORKERS threads
+# for each request; give up on any that haven't answered within the
+# deadline (seconds).  Fetches also time out their sockets after the
+# deadline, so a hung calendar doesn't hold its thread.
+FETCH_WORKERS = 8
+FETCH_DEADLINE = 10
+# Events per page from the calendar API (at most 2500), and the
+# only event fields we ask for.
+EVENT_PAGE_SIZE = 250
+EVENT_FIELDS = "items(summary,start,end,transparency),nextPageToken"
+SYNC_FIELDS = "items(id,status,summary,start,end,transparency),nextPageToken,nextSyncToken"
 CLIENT_SECRET_FILE = secrets.admin_secrets.google_key_file  ## You'll need this
 APPLICATION_NAME = 'MeetMe class project'
 
@@ -63,11 +83,46 @@ try:
     dbclient = MongoClient(MONGO_CLIENT_URL)
     db = getattr(dbclient, secrets.client_secrets.db)
     collection = db.dated
+    # Meetings are always looked up by uuid
+    collection.create_index('uuid', unique=True)
 
 except:
     print("Failure opening database.  Is Mongo running? Correct password?")
     sys.exit(1)
 
+####
+# Caches
+###
+
+# Busy events for each (user, calendar, date range), with the sync
+# token for fetching only what changed since.  Set EVENT_CACHE = 'mongo'
+# in CONFIG.py to share them between server processes.
+EVENT_CACHE_TTL = 60 * 60
+if getattr(CONFIG, 'EVENT_CACHE', 'memory') == 'mongo':
+  event_cache = cache.MongoCache(db.event_cache, ttl=EVENT_CACHE_TTL)
+else:
+  event_cache = cache.LRUCache(max_size=1000, ttl=EVENT_CACHE_TTL)
+
+# Session contents (the cookie only carries the session id).  Set
+# SESSION_STORE = 'mongo' in CONFIG.py when running several server
+# processes (e.g., gunicorn workers), so they all see the same sessions.
+SESSION_TTL = 24 * 60 * 60
+if getattr(CONFIG, 'SESSION_STORE', 'memory') == 'mongo':
+  session_cache = cache.MongoCache(db.sessions, ttl=SESSION_TTL)
+else:
+  session_cache = cache.LRUCache(max_size=10000, ttl=SESSION_TTL)
+app.session_interface = session_store.ServerSideSessionInterface(session_cache)
+
+# What the schedule and invitee pages show for each meeting, so a shared
+# link doesn't go to the database on every view.  deleteEventsCombine
+# drops a meeting's entry when it changes.  Set MEETING_CACHE = 'mongo'
+# in CONFIG.py to share them between server processes.
+MEETING_CACHE_TTL = 10 * 60
+if getattr(CONFIG, 'MEETING_CACHE', 'memory') == 'mongo':
+  meeting_cache = cache.MongoCache(db.meeting_cache, ttl=MEETING_CACHE_TTL)
+else:
+  meeting_cache = cache.LRUCache(max_size=1000, ttl=MEETING_CACHE_TTL)
+
 #############################
 #
 #  Pages (routed from URLs)
@@ -134,6 +189,9 @@ def valid_credentials():
     credentials in the session.  This is a 'truthy' value.
     Return None if we don't have credentials, or if they
     have expired or are otherwise invalid.  This is a 'falsy' value. 
+    Expired credentials with a refresh token are refreshed here
+    (see refresh_credentials) and saved back to the session, rather
+    than sending the user through the whole OAuth flow again.
     """
     if 'credentials' not in flask.session:
       return None
@@ -141,11 +199,45 @@ def valid_credentials():
     credentials = client.OAuth2Credentials.from_json(
         flask.session['credentials'])
 
-    if (credentials.invalid or
-        credentials.access_token_expired):
+    if credentials.invalid:
       return None
+    if credentials.access_token_expired:
+      if not credentials.refresh_token:
+        return None
+      credentials = refresh_credentials(credentials)
+      if credentials is None:
+        return None
+      flask.session['credentials'] = credentials.to_json()
     return credentials
 
+# Parallel requests from the same user all find the access token
+# expired at once; only the first refreshes it, and the others wait
+# for it and use its result (kept in refreshed_credentials).
+_refresh_locks = [threading.Lock() for i in range(64)]
+refreshed_credentials = cache.LRUCache(max_size=1000, ttl=5 * 60)
+
+def refresh_credentials(credentials):
+    """
+    Get a new access token for expired credentials, using their
+    refresh token.  Returns the refreshed credentials, or None if
+    Google refuses (e.g., the user revoked our access).
+    """
+    key = user_key(credentials)
+    with _refresh_locks[hash(key) % len(_refresh_locks)]:
+      fresh = refreshed_credentials.get(key)
+      if fresh is not None:
+        fresh = client.OAuth2Credentials.from_json(fresh)
+        if not fresh.access_token_expired:
+          return fresh
+      app.logger.debug("Refreshing access token")
+      try:
+        credentials.refresh(pooled_http())
+      except client.AccessTokenRefreshError as err:
+        app.logger.debug("Refresh failed: {}".format(err))
+        return None
+      refreshed_credentials.put(key, credentials.to_json())
+      return credentials
+
 
 def get_gcal_service(credentials):
   """
@@ -158,11 +250,77 @@ def get_gcal_service(credentials):
   Then the second call will succeed without additional authorization.
   """
   app.logger.debug("Entering get_gcal_service")
-  http_auth = credentials.authorize(httplib2.Http())
-  service = discovery.build('calendar', 'v3', http=http_auth)
+  start = time.time()
+  http_auth = credentials.authorize(pooled_http())
+  service = discovery.build_from_document(calendar_discovery(), http=http_auth)
+  record_timing('service_builds', start)
   app.logger.debug("Returning service")
   return service
 
+####
+#
+#  Reusing what we can between requests:  The calendar API's
+#  discovery document is fetched once per process, and each thread
+#  keeps its open HTTP connections so requests from that thread
+#  reuse them (skipping the TLS handshake).  httplib2.Http objects
+#  are not thread-safe, and credentials.authorize patches the Http it
+#  is given, so we make a fresh Http each time but hand it the
+#  thread's connections.  The threads that fetch calendars last only
+#  one request, so their connections are kept in a pool shared by
+#  all threads instead (see fetch_with_http).
+#
+####
+
+_discovery_document = None
+_discovery_lock = threading.Lock()
+_thread_http = threading.local()
+_idle_connections = {}    # httplib2 connection key -> idle connections
+_idle_lock = threading.Lock()
+_timing_lock = threading.Lock()
+
+# Counts and total milliseconds, reported by /stats
+service_timings = { 'discovery_fetches': {'count': 0, 'total_ms': 0.0},
+                    'service_builds': {'count': 0, 'total_ms': 0.0}
+                  }
+
+def record_timing(name, start):
+  """
+  Add the time since start to service_timings[name].
+  """
+  elapsed = (time.time() - start) * 1000
+  with _timing_lock:
+    timing = service_timings[name]
+    timing['count'] += 1
+    timing['total_ms'] += elapsed
+
+def calendar_discovery():
+  """
+  The parsed discovery document for the calendar v3 API, fetched the
+  first time it is needed by this process.
+  """
+  global _discovery_document
+  with _discovery_lock:
+    if _discovery_document is None:
+      start = time.time()
+      uri = discovery.DISCOVERY_URI.format(api='calendar', apiVersion='v3')
+      resp, content = pooled_http().request(uri)
+      if resp.status >= 400:
+        raise HttpError(resp, content, uri=uri)
+      _discovery_document = json.loads(content.decode('utf-8'))
+      record_timing('discovery_fetches', start)
+    return _discovery_document
+
+def pooled_http(timeout=None):
+  """
+  A new httplib2.Http sharing this thread's open connections, with
+  socket timeout in seconds for new connections (None for the default).
+  """
+  if not hasattr(_thread_http, 'connections'):
+    _thread_http.connections = {}
+  http = httplib2.Http(timeout=timeout)
+  http.connections = _thread_http.connections
+  return http
+
 @app.route('/oauth2callback')
 def oauth2callback():
   """
@@ -285,41 +443,44 @@ def chooseCal():
   gcal_service = get_gcal_service(credentials)
   app.logger.debug("Returned from get_gcal_service")
   
-  # Converts the arrow time objects to datetime to be used for the choosing of events in the given calendars.
-  begin_date = arrow.get(flask.session['begin_date'])
-  end_date = arrow.get(flask.session['end_date'])
-  begin_time = arrow.get(flask.session['begin_time']).datetime.timetz()
-  end_time = arrow.get(flask.session['end_time']).datetime.timetz()
+  # The user's time zone comes from their browser (see index.html).
+  # Dates and times of day are wall-clock values in that zone; the
+  # agendas are in UTC minutes, converted to and from it at the edges.
+  if request.form.get('tz'):
+    session['tz'] = request.form.get('tz')
+  zone = time_zone(session.get('tz'))
+  first_day = arrow.get(flask.session['begin_date']).date()
+  last_day = arrow.get(flask.session['end_date']).date()
+  begin_time = arrow.get(flask.session['begin_time']).time()
+  end_time = arrow.get(flask.session['end_time']).time()
+  # Whole days, from midnight before first_day to midnight after last_day
+  query_begin = datetime.datetime.combine(first_day, datetime.time(tzinfo=zone)).isoformat()
+  query_end = datetime.datetime.combine(last_day + datetime.timedelta(days=1),
+                                        datetime.time(tzinfo=zone)).isoformat()
 
   sCal = request.form.getlist('vals') # Obtains values of calendars in html
   events = []
-  free_times = agenda.Agenda()
-  freeblocks = agenda.Agenda()
 
-  # Gets all of the events in the calendar ranging the dates and not times
-  for cal in sCal:
-    events.extend(list_events(gcal_service, begin_date.isoformat(), end_date.isoformat(), cal))
+  # Gets all of the events in the calendar ranging the dates and not times.
+  # Full events are only needed to show their titles; otherwise one
+  # free/busy query covers every calendar.
+  if request.form.get('titles'):
+    events, failures = fetch_events(gcal_service, query_begin, query_end, sCal,
+                                    lambda: credentials.authorize(pooled_http(FETCH_DEADLINE)),
+                                    user=user_key(credentials))
+  else:
+    events, failures = fetch_busy(gcal_service, query_begin, query_end, sCal)
+  for cal in failures:
+    flask.flash("Could not get events from calendar {}: {}".format(cal, failures[cal]))
   
-  # Gets the events from the already gotten events that lie within the time range.
-  for e in events:
-    if not (arrow.get(e['end_time']).timetz() < begin_time or arrow.get(e['start_time']).timetz() > end_time):
-      appt = agenda.Appt(arrow.get(e["start_time"]).datetime.date(), arrow.get(e["start_time"]).datetime.timetz(), arrow.get(e["end_time"]).datetime.timetz(), e["summary"])
-      free_times.append(appt)
-
-  day_gap = end_date.datetime.date() - begin_date.datetime.date()
-  free_date = begin_date
-  for i in range(day_gap.days +1):
-    free_date = begin_date.replace(days=+i)
-    free_appt = agenda.Appt(free_date.datetime.date(), begin_time, end_time, "free time")
-    freeblocks.append(free_appt)
-
-  comp_free = free_times.complement(freeblocks) # Problem with code here
-  flash_list = []
-  for appt in comp_free:
-    flash_list.append(str(appt))
-
-  for appt in free_times:
-    flash_list.append(str(appt))
+  # Events may span several days (or be all-day events, on the user's
+  # days), so they are clipped to the freeblocks rather than filtered.
+  busy_times = agenda.Agenda.from_events(events, tzinfo=zone)
+  freeblocks = agenda.Agenda.daily(first_day, last_day, begin_time, end_time, "free time", zone)
+
+  free_times = busy_times.clip(freeblocks)
+  comp_free = free_times.complement(freeblocks)
+  flash_list = list(comp_free.lines()) + list(free_times.lines())
 
   flash_list.sort()
 
@@ -370,20 +531,88 @@ def deleteEvents():
   for event in removeList:
     session['events'].remove(event)
 
-  insertToDatabase(session['events'], session['uuid'], session['begin_date'], session['end_date'], session['begin_time'], session['end_time'])
+  insertToDatabase(session['events'], session['uuid'], session['begin_date'], session['end_date'], session['begin_time'], session['end_time'],
+                   session.get('tz'))
 
   return flask.redirect(url_for('schedule', uuid = session['uuid']))
 
-def insertToDatabase(events, uuid, begin_date, end_date, begin_time, end_time):
-  record = { 'events': events,
-             'uuid': uuid,
+def insertToDatabase(events, uuid, begin_date, end_date, begin_time, end_time, tz_name=None):
+  """
+  Creates the record for a new meeting.
+  Input:
+    events: The maker's free times, as Appt strings
+    uuid: Id of the meeting
+    begin_date, end_date, begin_time, end_time: The range, as ISO strings
+    tz_name: The maker's time zone (see time_zone), which events are in
+  Output:
+    None
+  The common free times are kept in 'free' as documents with native
+  dates (see free_documents), and each invitee's free times are
+  added to 'submissions' (see merge_submission).  The meeting keeps
+  the maker's time zone in 'tz', so its free times are stored in UTC
+  and invitees in other zones are compared in real time.
+  """
+  freeAgenda = agenda.NormalizedAgenda()
+  for appt in agenda.Appt.from_strings(events):
+    freeAgenda.append(appt)
+  if tz_name:
+    freeAgenda = freeAgenda.localized(time_zone(tz_name))
+  record = { 'uuid': uuid,
+             'tz': tz_name,
              'begin_date': begin_date,
              'end_date': end_date,
              'begin_time': begin_time,
-             'end_time': end_time
+             'end_time': end_time,
+             'free': free_documents(freeAgenda),
+             'submissions': [],
+             'version': 0
           }
 
-  collection.insert(record)
+  collection.insert_one(record)
+
+def free_documents(freeAgenda):
+  """
+  Helper function to store an agenda in Mongo
+  Input:
+    freeAgenda: An agenda of free times
+  Output:
+    List of {'begin', 'end', 'desc'} documents, begin and end as naive
+    datetimes: in UTC for appointments with a time zone, otherwise
+    wall-clock times
+  """
+  return [{ 'begin': agenda.from_minutes(appt.begin_minute),
+            'end': agenda.from_minutes(appt.end_minute),
+            'desc': appt.desc
+          } for appt in freeAgenda.appts]
+
+def meeting_free_times(record):
+  """
+  Helper function to read the common free times of a meeting
+  Input:
+    record: The meeting's document from the database
+  Output:
+    Returns an agenda of the free times, in order, in the meeting's
+    time zone (see meeting_zone)
+  """
+  if 'free' not in record:
+    # Stored before free times were documents
+    return meeting_agenda(record.get('events', []))
+  zone = meeting_zone(record)
+  freeAgenda = agenda.NormalizedAgenda()
+  for doc in record['free']:
+    freeAgenda.append(agenda.Appt.from_minutes(agenda.to_minutes(doc['begin']),
+                                               agenda.to_minutes(doc['end']), doc['desc'], zone))
+  return freeAgenda
+
+def meeting_zone(record):
+  """
+  The time zone of a meeting: the maker's, whose free times are stored
+  in UTC; or None for meetings stored before they had one, whose free
+  times are wall-clock times.
+  """
+  if record.get('tz'):
+    return time_zone(record['tz'])
+  return None
 
 @app.route('/deleteEventsCombine', methods=['POST'])
 def deleteEventsCombine():
@@ -411,48 +640,96 @@ def deleteEventsCombine():
       session['events'].remove(event)
       session['events'].append(str(tmp))
 
-  for event in session['events']:
-    fields = event.split()
-    if (fields[1].strip() != "free time"):
-      session['events'].remove(event)
+  session['events'] = [event for event in session['events']
+                       if event.split("|")[1].strip() == "free time"]
 
-  dataAgenda = setAgendas(session['databaseEvents'], session['events'])
-
-  collection.update({'uuid': session['uuid']}, {"$set":{'events' : str(dataAgenda)}})
+  newAgenda = agenda.NormalizedAgenda()
+  for appt in agenda.Appt.from_strings(session['events']):
+    newAgenda.append(appt)
+  merge_submission(collection, session['uuid'], newAgenda, time_zone(session.get('tz')))
+  meeting_cache.delete(session['uuid'])
   
   return flask.redirect(url_for('schedule', uuid = session['uuid']))
 
-def setAgendas(databaseEvents, events):
+def merge_submission(meetings, uuid, newAgenda, tzinfo=None):
   """
-  Helper function to intersect agendas
+  Adds an invitee's free times to a meeting
   Input:
-    databaseEvents: Free times that are in the database
-    events: Free times that the user wants added
+    meetings: The collection of meetings
+    uuid: Id of the meeting
+    newAgenda: The invitee's free times, as wall-clock times
+    tzinfo: The invitee's time zone (default the meeting's)
   Output:
-    Returns the intersected agendas
+    Returns the meeting's common free times, including newAgenda
+  The new common free times are the previous ones intersected with
+  newAgenda.  They are written together with the submission in one
+  update, which only applies if the meeting's version is still the one
+  we read; if another invitee got in first, we read again and retry.
+  So simultaneous invitees can't overwrite each other's free times.
+  newAgenda is converted from the invitee's time zone, so an invitee
+  free 9 to 5 in New York shares 9 to 2 with a maker free 9 to 5 in
+  Los Angeles.
   """
-  curAgenda = agenda.Agenda()
-  newAgenda = agenda.Agenda()
-  for event in databaseEvents:
-    curAgenda.append(agenda.Appt.from_string(event))
-
-  for event in databaseEvents:
-    curAgenda.append(agenda.Appt.from_string(event))
-
-  return curAgenda.intersect(newAgenda)
-
+  while True:
+    record = meetings.find_one({'uuid': uuid}, {'free': 1, 'events': 1, 'version': 1, 'tz': 1})
+    if record is None:
+      raise KeyError(uuid)
+    version = record.get('version')   # None for meetings stored before versions
+    zone = meeting_zone(record)
+    if zone is not None:
+      newAgenda = newAgenda.localized(tzinfo or zone)
+    dataAgenda = agenda.Agenda.intersect_all([meeting_free_times(record), newAgenda])
+    result = meetings.update_one({'uuid': uuid, 'version': version},
+                                 {"$set": {'free': free_documents(dataAgenda),
+                                           'version': (version or 0) + 1},
+                                  "$push": {'submissions': {'free': free_documents(newAgenda),
+                                                            'submitted': datetime.datetime.utcnow()}}})
+    if result.modified_count == 1:
+      return dataAgenda
+
+
+def meeting_view(uuid):
+  """
+  Helper function to read a meeting for the schedule and invitee pages
+  Input:
+    uuid: Id of the meeting
+  Output:
+    Dict of the meeting's session values, with its common free times as
+    Appt strings in 'events', or None if there is no such meeting
+  Kept in meeting_cache until the meeting changes; don't modify it.
+  """
+  view = meeting_cache.get(uuid)
+  if view is None:
+    record = collection.find_one({'uuid': uuid})
+    if record is None:
+      return None
+    view = { 'uuid': record['uuid'],
+             'begin_date': record['begin_date'],
+             'end_date': record['end_date'],
+             'begin_time': record['begin_time'],
+             'end_time': record['end_time'],
+             'formattedBeginTime': arrow.get(record['begin_time']).format("HH:mm"),
+             'formattedEndTime': arrow.get(record['end_time']).format("HH:mm"),
+             'meeting_tz': record.get('tz'),
+             'events': list(meeting_free_times(record).lines())
+           }
+    meeting_cache.put(uuid, view)
+    # If an invitee changed the meeting after we read it, our put may
+    # have come after deleteEventsCombine dropped the entry, caching
+    # the old view.  Checking after the put catches every ordering.
+    current = collection.find_one({'uuid': uuid}, {'version': 1})
+    if current is None or current.get('version') != record.get('version'):
+      meeting_cache.delete(uuid)
+  return view
 
 @app.route('/invitee/<uuid>')
 def invitee(uuid):
-  sessionVariables = collection.find_one({'uuid': uuid})
-  session['end_time'] = sessionVariables['end_time']
-  session['begin_time'] = sessionVariables['begin_time']
-  session['end_date'] = sessionVariables['end_date']
-  session['begin_date'] = sessionVariables['begin_date']
-  session['databaseEvents'] = sessionVariables['events']
-  session['uuid'] = sessionVariables['uuid']
-  session['formattedEndTime'] = arrow.get(session['end_time']).format("HH:mm")
-  session['formattedBeginTime'] = arrow.get(session['begin_time']).format("HH:mm")
+  sessionVariables = meeting_view(uuid)
+  if sessionVariables is None:
+    flask.abort(404)
+  for key in ['uuid', 'begin_date', 'end_date', 'begin_time', 'end_time',
+              'formattedBeginTime', 'formattedEndTime']:
+    session[key] = sessionVariables[key]
 
   app.logger.debug(session)
   return(render_template('invitee.html'))
@@ -460,19 +737,69 @@ def invitee(uuid):
 # Needs testing
 @app.route('/schedule/<uuid>')
 def schedule(uuid):
-  sessionVariables = collection.find_one({'uuid': uuid})
-  session['end_time'] = sessionVariables['end_time']
-  session['begin_time'] = sessionVariables['begin_time']
-  session['end_date'] = sessionVariables['end_date']
-  session['begin_date'] = sessionVariables['begin_date']
-  session['events'] = sessionVariables['events']
-  session['uuid'] = sessionVariables['uuid']
-  session['formattedEndTime'] = arrow.get(session['end_time']).format("HH:mm")
-  session['formattedBeginTime'] = arrow.get(session['begin_time']).format("HH:mm")
+  sessionVariables = meeting_view(uuid)
+  if sessionVariables is None:
+    flask.abort(404)
+  for key in ['uuid', 'begin_date', 'end_date', 'begin_time', 'end_time',
+              'formattedBeginTime', 'formattedEndTime', 'meeting_tz']:
+    session[key] = sessionVariables[key]
+  session['events'] = list(sessionVariables['events'])   # a copy; views change it
   session['url'] = url_for('invitee', uuid= session['uuid'], _external=True)
 
   return(render_template('schedule.html'))
 
+@app.route('/stats')
+def stats():
+  """
+  Cache counters for monitoring, as JSON.
+  """
+  return flask.jsonify(event_cache=event_cache.stats(),
+                       session_cache=session_cache.stats(),
+                       meeting_cache=meeting_cache.stats(),
+                       service_timings=service_timings)
+
+@app.route('/slots/<uuid>')
+def slots(uuid):
+  """
+  Earliest meeting slots in the free times stored for a meeting.
+  Input (URL parameters):
+    duration: Length of the meeting in minutes (default 30)
+    granularity: Slots start on multiples of this many minutes (optional)
+    k: How many slots to return (default 5)
+  Output:
+    JSON object with a list of slots in Appt string format.
+  """
+  record = collection.find_one({'uuid': uuid})
+  if record is None:
+    flask.abort(404)
+  duration = datetime.timedelta(minutes=request.args.get('duration', 30, type=int))
+  granularity = request.args.get('granularity', None, type=int)
+  if granularity:
+    granularity = datetime.timedelta(minutes=granularity)
+  k = request.args.get('k', 5, type=int)
+  try:
+    found = agenda.Agenda().earliest_slots(meeting_free_times(record), duration, k, granularity)
+  except ValueError as err:
+    return flask.jsonify(error=str(err)), 400
+  return flask.jsonify(slots=[str(appt) for appt in found])
+
+def meeting_agenda(events):
+  """
+  Helper function to build an agenda from free times stored as strings,
+  as meetings were before their free times were documents
+  Input:
+    events: Stored free times, a list of Appt strings or one string
+      with an Appt on each line
+  Output:
+    Returns an agenda of the free times, in order
+  """
+  if isinstance(events, str):
+    events = events.splitlines()
+  freeAgenda = agenda.NormalizedAgenda()
+  for appt in agenda.Appt.from_strings(events):
+    freeAgenda.append(appt)
+  return freeAgenda
+
 ####
 #
 #   Initialize session variables 
@@ -541,6 +868,23 @@ def interpret_date( text ):
         raise
     return as_arrow.isoformat()
 
+@functools.lru_cache(maxsize=256)
+def time_zone(name):
+    """
+    The tzinfo for a time zone name like 'America/Los_Angeles' (as
+    browsers report it), or the server's local time zone if name is
+    None or not a known zone.  Loading a time zone reads its rules from
+    disk, so recently used zones are kept and the same tzinfo returned.
+    The name comes from the client: gettz would read any file named
+    by a path, so paths are refused.
+    """
+    if not name or name.startswith("/") or ".." in name:
+        return tz.tzlocal()
+    try:
+        return tz.gettz(name) or tz.tzlocal()
+    except Exception:
+        return tz.tzlocal()
+
 def next_day(isotext):
     """
     ISO date + 1 day (used in query to Google calendar)
@@ -587,24 +931,285 @@ def list_calendars(service):
             })
     return sorted(result, key=cal_sort_key)
 
-def list_events(service, begin_time, end_time, calId):
-  # FIXME: Maybe make the events into classes here so we can sort and combine them later.
-  app.logger.debug("Entering list_events")
-  event_list = service.events().list(calendarId=calId, timeMin=begin_time, timeMax=end_time).execute()['items']
+def fetch_events(service, begin_time, end_time, calIds, http_factory=None, deadline=None, user=None):
+  """
+  Gets the events of several calendars at once, each list_events call
+  running in a thread pool of this request's own, so calendars that
+  hang don't use up threads other requests need.
+  Input:
+    service: Google calendar service object
+    begin_time, end_time: ISO date range, as for list_events
+    calIds: Ids of the calendars to fetch
+    http_factory: Makes an authorized Http for each fetch, since Http
+      objects can't be shared between threads. None to use the service's own.
+    deadline: Seconds to wait for all calendars (default FETCH_DEADLINE)
+    user: If given, fetch with sync_events for this user (see user_key),
+      so only changes since the last fetch are downloaded.
+  Output:
+    (events, failures): The events of every calendar that answered in
+    time, sorted by start time, and a dict from calendar id to the reason
+    for each calendar that failed or timed out.
+  """
+  if deadline is None:
+    deadline = FETCH_DEADLINE
+  futures = {}
+  pool = ThreadPoolExecutor(max_workers=max(1, min(FETCH_WORKERS, len(calIds))))
+  try:
+    for cal in calIds:
+      if user is None:
+        future = pool.submit(fetch_with_http, http_factory, list_events,
+                             service, begin_time, end_time, cal)
+      else:
+        future = pool.submit(fetch_with_http, http_factory, sync_events,
+                             service, begin_time, end_time, cal, user)
+      futures[future] = cal
+    done, not_done = wait(futures, timeout=deadline)
+  finally:
+    # Don't wait for fetches still running past the deadline
+    pool.shutdown(wait=False)
+  events = []
+  failures = {}
+  for future in done:
+    try:
+      events.extend(future.result())
+    except Exception as err:
+      app.logger.debug("Fetching calendar {} failed: {}".format(futures[future], err))
+      failures[futures[future]] = str(err) or type(err).__name__
+  for future in not_done:
+    future.cancel()
+    failures[futures[future]] = "timed out after {} seconds".format(deadline)
+  return sorted(events, key=lambda k: k["start_time"]), failures
+
+def fetch_busy(service, begin_time, end_time, calIds, http=None):
+  """
+  Gets the busy times of several calendars with a single free/busy query,
+  instead of downloading their full events.
+  Input:
+    service: Google calendar service object
+    begin_time, end_time: ISO date range, as for list_events
+    calIds: Ids of the calendars to query
+    http: Optional authorized Http to execute the query with
+  Output:
+    (events, failures) as for fetch_events.  Each busy time is an event
+    dict with summary "busy".
+  """
+  app.logger.debug("Entering fetch_busy")
+  query = { "timeMin": begin_time,
+            "timeMax": end_time,
+            "items": [{"id": cal} for cal in calIds]
+          }
+  try:
+    calendars = service.freebusy().query(body=query).execute(http=http)['calendars']
+  except Exception as err:
+    app.logger.debug("Free/busy query failed: {}".format(err))
+    return [], dict((cal, str(err) or type(err).__name__) for cal in calIds)
   results = []
-  # app.logger.debug("Events(in list_events): {}".format(event_list))
-  for event in event_list:
-    if "transparency" not in event:
-      summary = event["summary"]
-      start_time = event["start"]["dateTime"]
-      end_time = event["end"]["dateTime"]
-
+  failures = {}
+  for cal in calIds:
+    info = calendars.get(cal, {})
+    if "errors" in info:
+      failures[cal] = ", ".join(error.get("reason", "error") for error in info["errors"])
+      continue
+    for busy in info.get("busy", []):
       results.append(
-        { "summary": summary,
-          "start_time": start_time,
-          "end_time": end_time
+        { "summary": "busy",
+          "start_time": busy["start"],
+          "end_time": busy["end"]
           })
-  return sorted(results, key=lambda k: k["start_time"])
+  return sorted(results, key=lambda k: k["start_time"]), failures
+
+def fetch_with_http(http_factory, fetch, *args):
+  """
+  Calls fetch(*args, http=http_factory()) in a fetch pool thread, so the
+  Http is made in (and its connections belong to) that thread.  The
+  Http borrows idle connections left by earlier fetches, and returns
+  them if the fetch succeeds; after a failure they may be in any state,
+  so they are closed.
+  """
+  if not http_factory:
+    return fetch(*args, http=None)
+  http = http_factory()
+  http.connections = checkout_connections()
+  try:
+    result = fetch(*args, http=http)
+  except Exception:
+    for conn in http.connections.values():
+      conn.close()
+    raise
+  checkin_connections(http.connections)
+  return result
+
+def checkout_connections():
+  """
+  Idle connections for one Http to use, at most one for each host, as
+  a dict like httplib2.Http.connections.  Nothing else uses them until
+  they are checked in again.
+  """
+  with _idle_lock:
+    return dict((key, idle.pop()) for key, idle in _idle_connections.items() if idle)
+
+def checkin_connections(connections):
+  """
+  Keep the connections of a finished fetch (a dict like
+  httplib2.Http.connections) for later fetches, up to FETCH_WORKERS
+  for each host, and close the rest.
+  """
+  extra = []
+  with _idle_lock:
+    for key, conn in connections.items():
+      idle = _idle_connections.setdefault(key, [])
+      if len(idle) < FETCH_WORKERS:
+        idle.append(conn)
+      else:
+        extra.append(conn)
+  for conn in extra:
+    conn.close()
+
+def list_events(service, begin_time, end_time, calId, http=None):
+  """
+  All the busy events of a calendar in a date range, sorted by start time.
+  See iter_events.
+  """
+  app.logger.debug("Entering list_events")
+  return sorted(iter_events(service, begin_time, end_time, calId, http), key=lambda k: k["start_time"])
+
+def iter_events(service, begin_time, end_time, calId, http=None, page_size=None, sync=None):
+  """
+  Generator of the busy events of a calendar in a date range, yielded
+  a page at a time as the pages arrive from Google.
+  Input:
+    service: Google calendar service object
+    begin_time, end_time: ISO date range
+    calId: Id of the calendar
+    http: Optional authorized Http to execute the requests with
+    page_size: Events per page (default EVENT_PAGE_SIZE)
+    sync: If a dict, the sync token Google returns with the last page
+      is put in sync['sync_token'] (see sync_events).  The events then
+      come in no particular order.
+  Output:
+    Yields dicts with summary, start_time and end_time (see event_record).
+    Recurring events are expanded into their instances, in order of
+    start time.
+  Only the fields we use are requested.
+  """
+  if page_size is None:
+    page_size = EVENT_PAGE_SIZE
+  if sync is None:
+    query = dict(orderBy="startTime", fields=EVENT_FIELDS)
+  else:
+    # As a later syncToken request will be, which can't be ordered
+    query = dict(fields=SYNC_FIELDS)
+  for page in event_pages(service, http, calendarId=calId, timeMin=begin_time, timeMax=end_time,
+                          singleEvents=True, maxResults=page_size, **query):
+    for event in page.get('items', []):
+      record = event_record(event)
+      if record is not None:
+        yield record
+    if sync is not None and page.get('nextSyncToken'):
+      sync['sync_token'] = page['nextSyncToken']
+
+def event_pages(service, http=None, **query):
+  """
+  Generator of the pages of service.events().list(**query), following
+  nextPageToken to the last page.
+  """
+  page_token = None
+  while True:
+    page = service.events().list(pageToken=page_token, **query).execute(http=http)
+    yield page
+    page_token = page.get('nextPageToken')
+    if not page_token:
+      return
+
+def event_record(event):
+  """
+  The dict we keep for a calendar event: its id, summary, start_time and
+  end_time.  None if the event doesn't make us busy: it is transparent
+  (marked free) or cancelled (as deleted events are in a sync).
+  All-day events have just a date for start_time and end_time (the day
+  after the last day); see agenda.parse_rfc3339.
+  """
+  if event.get("status") == "cancelled" or event.get("transparency") == "transparent":
+    return None
+  return { "id": event.get("id"),
+           "summary": event.get("summary", "(no title)"),
+           "start_time": event["start"].get("dateTime", event["start"].get("date")),
+           "end_time": event["end"].get("dateTime", event["end"].get("date"))
+         }
+
+def sync_events(service, begin_time, end_time, calId, user, http=None):
+  """
+  The busy events of a calendar in a date range, like list_events, but
+  kept in event_cache for the user.  The first fetch downloads every
+  event and remembers the sync token Google returns; later fetches send
+  the token and merge in just the events added, changed or deleted
+  since.  If Google has expired the token, we start over.  Changes
+  come for the whole calendar, so those outside the date range are
+  dropped.
+  Input:
+    service, begin_time, end_time, calId, http: As for list_events
+    user: Whose calendar this is (see user_key)
+  Output:
+    List of event dicts, sorted by start time.
+  """
+  key = "{}|{}|{}|{}".format(user, calId, begin_time, end_time)
+  entry = event_cache.get(key)
+  events = None
+  if entry is not None:
+    events = dict((e["id"], e) for e in entry["events"])
+    token = entry["sync_token"]
+    try:
+      for page in event_pages(service, http, calendarId=calId, syncToken=token,
+                              singleEvents=True, maxResults=EVENT_PAGE_SIZE, fields=SYNC_FIELDS):
+        for event in page.get('items', []):
+          record = event_record(event)
+          if record is None:
+            events.pop(event["id"], None)
+          else:
+            events[event["id"]] = record
+        token = page.get('nextSyncToken', token)
+    except HttpError as err:
+      if err.resp.status != 410:
+        raise
+      app.logger.debug("Sync token for {} expired; fetching everything".format(calId))
+      events = None
+  if events is None:
+    sync = {}
+    events = {}
+    for record in iter_events(service, begin_time, end_time, calId, http, sync=sync):
+      events[record["id"]] = record
+    token = sync.get('sync_token')
+  events = dict((id, event) for id, event in events.items()
+                if rfc3339_before(event["start_time"], end_time)
+                and rfc3339_before(begin_time, event["end_time"]))
+  if token:
+    event_cache.put(key, {"events": list(events.values()), "sync_token": token})
+  return sorted(events.values(), key=lambda k: k["start_time"])
+
+def rfc3339_before(first, second):
+  """
+  Whether the RFC 3339 time first is before second.  A date alone is
+  midnight in the time zone of the other (see agenda.parse_rfc3339).
+  """
+  first_minute, first_second, first_offset = agenda.parse_rfc3339(first)
+  second_minute, second_second, second_offset = agenda.parse_rfc3339(second)
+  if first_offset is None:
+    first_offset = second_offset or 0
+  if second_offset is None:
+    second_offset = first_offset
+  return ((first_minute - first_offset, first_second) <
+          (second_minute - second_offset, second_second))
+
+def user_key(credentials):
+  """
+  A stable key for the user the credentials belong to, for caching their
+  data: their Google account id if we have it, otherwise a hash of their
+  refresh token (which lasts until they revoke access).
+  """
+  if credentials.id_token and "sub" in credentials.id_token:
+    return credentials.id_token["sub"]
+  token = credentials.refresh_token or credentials.access_token
+  return hashlib.sha256(token.encode("utf-8")).hexdigest()
 
 def cal_sort_key( cal ):
     """
@@ -0,0 +1,77 @@
+"""Server-side sessions for Flask.
+
+   Flask's default session is the whole session dict, serialized
+   and signed, in a cookie that the browser sends with every request.
+   Our sessions hold lists of events, which makes that cookie large
+   (and can overflow the browser's cookie limit).  With
+   ServerSideSessionInterface the cookie holds only a random session
+   id, and the session dict is kept in a store: a cache.LRUCache for a
+   single server process, or a cache.MongoCache shared by several.
+
+   Use:  app.session_interface = ServerSideSessionInterface(store)
+"""
+
+import copy
+import uuid
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """A session dict that knows its id."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps session dicts in a store, and just their ids in cookies."""
+
+    def __init__(self, store):
+        """store: A cache.LRUCache or cache.MongoCache (anything with
+        get, put and delete) for the session dicts, keyed by id.
+        """
+        self.store = store
+
+    def open_session(self, app, request):
+        """The session whose id is in the request's cookie, or a
+        new empty one if there is none or it has expired.
+
+        The session is a deep copy of what is stored, so changes to
+        the lists in it are only kept if save_session stores them
+        (not if the request fails), whatever the store.
+        """
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                return ServerSideSession(copy.deepcopy(data), sid=sid)
+        return ServerSideSession(sid=uuid.uuid4().hex, new=True)
+
+    def save_session(self, app, session, response):
+        """Store the session and send its id back in the cookie.
+
+        The session is stored after every request, even when it
+        was not assigned to: views change lists inside it in place
+        (session['events'].remove(...)), which the session can't see,
+        and storing it also restarts its time-to-live.
+        """
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        self.store.put(session.sid, copy.deepcopy(dict(session)))
+        response.set_cookie(name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app))
@@ -0,0 +1,491 @@
+import agenda
+import datetime
+from dateutil import tz
+import io
+import random
+
+def random_agenda(rand, n, day=datetime.date(2016, 12, 1)):
+	"""An unsorted agenda of n random, possibly overlapping appointments
+	between 8:00 and 18:00 on day."""
+	result = agenda.Agenda()
+	for i in range(n):
+		begin = rand.randrange(8 * 60, 18 * 60 - 15, 15)
+		end = rand.randrange(begin + 15, 18 * 60 + 1, 15)
+		result.append(agenda.Appt(day,
+			datetime.time(begin // 60, begin % 60),
+			datetime.time(end // 60, end % 60),
+			"appt {}".format(i)))
+	return result
+
+def nested_intersect(mine, theirs, desc=""):
+	"""The original all-pairs Agenda.intersect, as a reference."""
+	default_desc = (desc == "")
+	result = agenda.Agenda()
+	for thisappt in mine.appts:
+		if default_desc:
+			desc = thisappt.desc
+		for otherappt in theirs.appts:
+			if thisappt.overlaps(otherappt):
+				result.append(thisappt.intersect(otherappt, desc))
+	return result
+
+def test_intersect():
+	keiko = agenda.Agenda.from_file(io.StringIO("""
+		2012.12.1 07:00 08:00  | Possible breakfast meeting
+		2012.12.1 10:00 12:00  | Late morning meeting
+		2012.12.1 14:00 18:00  | Afternoon meeting
+		"""))
+	kevin = agenda.Agenda.from_file(io.StringIO("""
+		2012.11.30 09:00 14:00 | I have an afternoon commitment on the 30th
+		2012.12.1  09:00 15:00 | I prefer morning meetings
+		"""))
+	assert str(keiko.intersect(kevin)) == (
+		"2012.12.01 10:00 12:00 | Late morning meeting\n" +
+		"2012.12.01 14:00 15:00 | Afternoon meeting")
+	assert str(kevin.intersect(keiko, "meet")) == (
+		"2012.12.01 10:00 12:00 | meet\n" +
+		"2012.12.01 14:00 15:00 | meet")
+
+def test_intersect_matches_nested_loop():
+	rand = random.Random(210)
+	for trial in range(200):
+		mine = random_agenda(rand, rand.randrange(0, 25))
+		theirs = random_agenda(rand, rand.randrange(0, 25))
+		for desc in ["", "common"]:
+			expected = nested_intersect(mine, theirs, desc)
+			actual = mine.intersect(theirs, desc)
+			assert str(actual) == str(expected)
+
+def scan_complement(busy, freeAgenda):
+	"""The original linear-scan Agenda.complement, as a reference."""
+	copy = busy.normalized()
+	comp = agenda.Agenda()
+	for freeblock in freeAgenda:
+		day = freeblock.begin.date()
+		cur_time = freeblock.begin
+		for appt in copy.appts:
+			if appt < freeblock:
+				continue
+			if appt > freeblock:
+				break
+			if cur_time < appt.begin:
+				comp.append(agenda.Appt(day, cur_time.time(), appt.begin.time(), freeblock.desc))
+			cur_time = max(appt.end, cur_time)
+		if cur_time < freeblock.end:
+			comp.append(agenda.Appt(day, cur_time.time(), freeblock.end.time(), freeblock.desc))
+	return comp
+
+def test_complement():
+	busy = agenda.Agenda.from_file(io.StringIO("""
+		2013.12.01 9:00 11:00 | morning meeting
+		2013.12.01 13:00 14:00 | afternoon meeting"""))
+	free = agenda.Agenda()
+	free.append(agenda.Appt.from_string("2013.12.01 08:00 15:00 | most of day"))
+	assert str(busy.complement(free)) == (
+		"2013.12.01 08:00 09:00 | most of day\n" +
+		"2013.12.01 11:00 13:00 | most of day\n" +
+		"2013.12.01 14:00 15:00 | most of day")
+	free = agenda.Agenda()
+	free.append(agenda.Appt.from_string("2013.12.02 11:00 15:00 | tomorrow"))
+	free.append(agenda.Appt.from_string("2013.12.01 12:30 13:30 | lunch"))
+	free.append(agenda.Appt.from_string("2013.12.01 10:30 13:30 | mid-day"))
+	assert str(busy.complement(free)) == (
+		"2013.12.02 11:00 15:00 | tomorrow\n" +
+		"2013.12.01 12:30 13:00 | lunch\n" +
+		"2013.12.01 11:00 13:00 | mid-day")
+
+def test_complement_matches_scan():
+	rand = random.Random(322)
+	first = datetime.date(2016, 12, 1)
+	for trial in range(50):
+		busy = agenda.Agenda()
+		free = agenda.Agenda()
+		for i in range(rand.randrange(1, 15)):
+			day = first + datetime.timedelta(days=i)
+			for appt in random_agenda(rand, rand.randrange(0, 10), day):
+				busy.append(appt)
+			begin = rand.randrange(8, 12)
+			free.append(agenda.Appt(day, datetime.time(begin),
+				datetime.time(rand.randrange(begin + 1, 19)), "free time"))
+		if trial % 2:
+			rand.shuffle(free.appts)
+		assert str(busy.complement(free)) == str(scan_complement(busy, free))
+
+def test_appt_minutes():
+	pacific = datetime.timezone(datetime.timedelta(hours=-8))
+	appt = agenda.Appt(datetime.date(2016, 12, 1),
+		datetime.time(9, 30, tzinfo=pacific), datetime.time(10, 45, tzinfo=pacific),
+		"aware")
+	assert appt.begin == datetime.datetime(2016, 12, 1, 9, 30, tzinfo=pacific)
+	assert appt.end.tzinfo is pacific
+	assert appt.end_minute - appt.begin_minute == 75
+	assert str(appt) == "2016.12.01 09:30 10:45 | aware"
+	assert not hasattr(appt, "__dict__")
+	eastern = agenda.Appt(datetime.date(2016, 12, 1),
+		datetime.time(12, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=-5))),
+		datetime.time(13, 0, tzinfo=datetime.timezone(datetime.timedelta(hours=-5))),
+		"eastern")
+	assert str(appt.intersect(eastern)) == "2016.12.01 09:30 10:00 | aware"
+
+def test_intersect_all_matches_pairwise():
+	rand = random.Random(410)
+	for trial in range(100):
+		agendas = [random_agenda(rand, rand.randrange(1, 8)) for i in range(rand.randrange(1, 6))]
+		expected = agendas[0].normalized()
+		for ag in agendas[1:]:
+			expected = expected.intersect(ag.normalized())
+		actual = agenda.Agenda.intersect_all(agendas)
+		assert str(actual) == str(expected)
+
+def test_intersect_all_empty():
+	try:
+		agenda.Agenda.intersect_all([])
+		assert False
+	except ValueError as err:
+		assert "agenda" in str(err)
+
+def test_intersect_quorum():
+	rand = random.Random(411)
+	for trial in range(100):
+		agendas = [random_agenda(rand, rand.randrange(0, 5)) for i in range(5)]
+		quorum = rand.randrange(1, 6)
+		actual = agenda.Agenda.intersect_quorum(agendas, quorum, "meet")
+		covered = set()
+		for appt in actual:
+			assert appt.desc == "meet"
+			covered.update(range(appt.begin_minute, appt.end_minute))
+		for prev, appt in zip(actual.appts, actual.appts[1:]):
+			assert prev < appt
+		minutes = set()
+		for ag in agendas:
+			for appt in ag:
+				minutes.update(range(appt.begin_minute, appt.end_minute))
+		expected = set(m for m in minutes
+			if sum(any(a.begin_minute <= m < a.end_minute for a in ag) for ag in agendas) >= quorum)
+		assert covered == expected
+		# Titles come from the first agenda free when each block starts
+		normalized = [ag.normalized() for ag in agendas]
+		for appt in agenda.Agenda.intersect_quorum(agendas, quorum):
+			owner = next(a for ag in normalized for a in ag
+				if a.begin_minute <= appt.begin_minute < a.end_minute)
+			assert appt.desc == owner.desc
+
+def test_earliest_slots():
+	busy = agenda.Agenda.from_file(io.StringIO("""
+		2013.12.01 9:00 10:10 | morning meeting
+		2013.12.01 13:00 14:00 | afternoon meeting"""))
+	free = agenda.Agenda.from_file(io.StringIO("""
+		2013.12.01 08:00 15:00 | free time
+		2013.12.02 08:00 15:00 | free time"""))
+	half_hour = datetime.timedelta(minutes=30)
+	slots = busy.earliest_slots(free, half_hour, 4)
+	assert str(slots) == (
+		"2013.12.01 08:00 08:30 | free time\n" +
+		"2013.12.01 08:30 09:00 | free time\n" +
+		"2013.12.01 10:10 10:40 | free time\n" +
+		"2013.12.01 10:40 11:10 | free time")
+	slots = busy.earliest_slots(free, half_hour, 3, datetime.timedelta(minutes=15))
+	assert str(slots) == (
+		"2013.12.01 08:00 08:30 | free time\n" +
+		"2013.12.01 08:15 08:45 | free time\n" +
+		"2013.12.01 08:30 09:00 | free time")
+	long_slots = busy.earliest_slots(free, datetime.timedelta(hours=3), 5, datetime.timedelta(hours=1))
+	assert str(long_slots) == (
+		"2013.12.02 08:00 11:00 | free time\n" +
+		"2013.12.02 09:00 12:00 | free time\n" +
+		"2013.12.02 10:00 13:00 | free time\n" +
+		"2013.12.02 11:00 14:00 | free time\n" +
+		"2013.12.02 12:00 15:00 | free time")
+
+def test_interval_index():
+	rand = random.Random(7)
+	day = datetime.date(2016, 12, 1)
+	for trial in range(50):
+		ag = random_agenda(rand, rand.randrange(0, 20), day)
+		index = ag.index()
+		for appt in random_agenda(rand, 5, day):
+			ag.append(appt)
+		for appt in rand.sample(ag.appts, len(ag.appts) // 3):
+			index.remove(appt)
+			ag.appts.remove(appt)
+		assert len(index) == len(ag)
+		for window in random_agenda(rand, 10, day):
+			expected = [appt for appt in ag if appt.overlaps(window)]
+			expected.sort(key=lambda appt: appt.begin_minute)
+			assert [str(appt) for appt in ag.overlapping(window)] == [str(appt) for appt in expected]
+			t = window.begin
+			assert ag.busy_at(t) == any(appt.begin <= t < appt.end for appt in ag)
+
+def test_interval_index_long_appointments():
+	rand = random.Random(17)
+	ag = agenda.Agenda()
+	start = agenda.to_minutes(datetime.datetime(2016, 12, 1))
+	index = ag.index()
+	for i in range(2000):
+		begin = start + rand.randrange(0, 60 * 24 * 60)
+		# A few appointments last weeks; the rest under an hour
+		length = rand.randrange(1, 30 * 24 * 60) if i % 100 == 0 else rand.randrange(1, 60)
+		ag.append(agenda.Appt.from_minutes(begin, begin + length, "appt {}".format(i)))
+		if i % 3 == 0:
+			appt = rand.choice(ag.appts)
+			index.remove(appt)
+			ag.appts.remove(appt)
+	assert len(index) == len(ag)
+	for trial in range(200):
+		begin = start + rand.randrange(0, 60 * 24 * 60)
+		window = agenda.Appt.from_minutes(begin, begin + rand.randrange(1, 24 * 60), "window")
+		expected = sorted((appt for appt in ag if appt.overlaps(window)), key=lambda appt: appt.begin_minute)
+		assert [id(appt) for appt in ag.overlapping(window)] == [id(appt) for appt in expected]
+	try:
+		index.remove(agenda.Appt.from_minutes(start, start + 1, "not there"))
+		assert False
+	except ValueError:
+		pass
+
+def test_normalized_agenda():
+	rand = random.Random(8)
+	for trial in range(100):
+		ag = random_agenda(rand, rand.randrange(0, 30))
+		incremental = agenda.NormalizedAgenda()
+		incremental.index()
+		for appt in ag:
+			incremental.append(appt)
+		ag.normalize()
+		assert incremental == ag
+		for window in random_agenda(rand, 3):
+			assert incremental.overlapping(window) == \
+				[appt for appt in incremental if appt.overlaps(window)]
+		free = random_agenda(rand, 3)
+		assert str(incremental.complement(free)) == str(ag.complement(free))
+
+def test_iter_appts_errors():
+	errors = []
+	text = io.StringIO("""# comment
+		2016.12.01 09:00 10:00 | fine
+
+		2016.12.01 11:00 10:00 | backwards
+		2016.12.01 09:00 | no end time
+		2016.12.02 09:00 10:00 | also fine""")
+	appts = agenda.iter_appts(text, errors)
+	assert str(next(appts)) == "2016.12.01 09:00 10:00 | fine"
+	assert errors == []
+	assert [str(appt) for appt in appts] == ["2016.12.02 09:00 10:00 | also fine"]
+	assert [(error.lineno, error.text) for error in errors] == [
+		(4, "2016.12.01 11:00 10:00 | backwards"),
+		(5, "2016.12.01 09:00 | no end time")]
+	assert errors[0].reason == "Appointment end must be after begin"
+
+def test_streaming_matches_agenda():
+	rand = random.Random(9)
+	first = datetime.date(2016, 12, 1)
+	for trial in range(50):
+		busy = agenda.Agenda()
+		theirs = agenda.Agenda()
+		free = agenda.Agenda()
+		for i in range(rand.randrange(1, 6)):
+			day = first + datetime.timedelta(days=i)
+			busy.appts.extend(random_agenda(rand, rand.randrange(0, 10), day).appts)
+			theirs.appts.extend(random_agenda(rand, rand.randrange(0, 10), day).appts)
+			free.append(agenda.Appt(day, datetime.time(9), datetime.time(17), "free time"))
+		busy.appts.sort(key=lambda appt: appt.begin_minute)
+		theirs.appts.sort(key=lambda appt: appt.begin_minute)
+		assert str(agenda.Agenda.from_file(io.StringIO(str(busy)))) == str(busy)
+		expected = busy.complement(free)
+		assert [str(appt) for appt in agenda.iter_complement(iter(busy), iter(free))] == \
+			str(expected).splitlines()
+		expected = busy.normalized().intersect(theirs.normalized(), "both")
+		assert [str(appt) for appt in agenda.iter_intersect(iter(busy), iter(theirs), "both")] == \
+			str(expected).splitlines()
+
+def test_fast_parser_matches_strict():
+	lines = ["2012.10.31 13:00 13:50 | CIS 210 lecture",
+		"  2013.12.1 8:00 17:00 |All the next day  ",
+		"2016.2.29 00:00 23:59 | leap day",
+		"2016.12.01 09:00 10:00 |",
+		"2016.12.01 9:5 10:00 | odd minutes"]
+	for line in lines:
+		assert str(agenda.Appt.from_string(line)) == str(agenda.Appt.from_string_strict(line))
+	assert [str(appt) for appt in agenda.Appt.from_strings(lines)] == \
+		[str(agenda.Appt.from_string_strict(line)) for line in lines]
+	for bad in ["2015.2.29 09:00 10:00 | not a leap year",
+			"2016.12.01 24:00 25:00 | too late",
+			"2016.12.01 10:00 09:00 | backwards",
+			"2016.12.01 09:00 10:00 | two | bars",
+			"2016.12.01 09:00 | missing end"]:
+		for parse in [agenda.Appt.from_string, agenda.Appt.from_string_strict]:
+			try:
+				parse(bad)
+				assert False, bad
+			except ValueError:
+				pass
+
+def test_dumps_loads():
+	rand = random.Random(11)
+	ag = random_agenda(rand, 50)
+	pacific = datetime.timezone(datetime.timedelta(hours=-8))
+	ag.append(agenda.Appt(datetime.date(2016, 12, 2),
+		datetime.time(9, tzinfo=pacific), datetime.time(10, tzinfo=pacific), "aware"))
+	text = ag.dumps()
+	assert text == "\n".join(str(appt) for appt in ag)
+	assert str(agenda.Agenda.loads(text)) == text
+	out = io.StringIO()
+	ag.write(out)
+	assert out.getvalue() == text + "\n"
+	assert agenda.Agenda().dumps() == ""
+
+def test_from_events_matches_datetime():
+	rand = random.Random(22)
+	events = []
+	for i in range(300):
+		offset = rand.choice(["-08:00", "-07:00", "+05:30", "Z"])
+		begin = rand.randrange(0, 23 * 60, 5)
+		end = rand.randrange(begin + 5, 24 * 60, 5)
+		day = "2016-12-{:02}".format(rand.randrange(1, 31))
+		events.append({"summary": "event {}".format(i),
+			"start_time": "{}T{:02}:{:02}:00{}".format(day, begin // 60, begin % 60, offset),
+			"end_time": "{}T{:02}:{:02}:{:02}{}".format(day, end // 60, end % 60, rand.randrange(60), offset)})
+	# Zero-length and sub-minute events are left out
+	short = [{"summary": "zero", "start_time": "2016-12-05T10:00:00-08:00", "end_time": "2016-12-05T10:00:00-08:00"},
+		{"summary": "seconds", "start_time": "2016-12-05T10:00:10-08:00", "end_time": "2016-12-05T10:00:50-08:00"}]
+	events[100:100] = short
+	pacific = datetime.timezone(datetime.timedelta(hours=-8))
+	begin_time = datetime.time(9, tzinfo=pacific)
+	end_time = datetime.time(17, tzinfo=pacific)
+	expected = agenda.Agenda()
+	for e in events:
+		if e in short:
+			continue
+		start = datetime.datetime.strptime(e["start_time"], "%Y-%m-%dT%H:%M:%S%z")
+		end = datetime.datetime.strptime(e["end_time"], "%Y-%m-%dT%H:%M:%S%z")
+		if not (end.timetz() < begin_time or start.timetz() > end_time):
+			expected.append(agenda.Appt(start.date(), start.timetz(), end.timetz(), e["summary"]))
+	result = agenda.Agenda.from_events(events, begin_time, end_time)
+	assert 0 < len(result) < len(events)
+	assert result.dumps() == expected.dumps()
+	assert [appt.begin_minute for appt in result] == [appt.begin_minute for appt in expected]
+	assert len(agenda.Agenda.from_events(events)) == len(events) - len(short)
+	assert len(agenda.Agenda.from_events(short)) == 0
+	for bad in ["2016-12-01 09:00", "2016-13-01T09:00:00Z", "2016-12-01T09:00:00+0800"]:
+		try:
+			agenda.parse_rfc3339(bad)
+			assert False, bad
+		except ValueError:
+			pass
+
+def test_multi_day_appts():
+	overnight = agenda.Appt(datetime.date(2016, 12, 1), datetime.time(22), datetime.time(6),
+		"overnight", datetime.date(2016, 12, 2))
+	assert overnight.end_minute - overnight.begin_minute == 8 * 60
+	assert str(overnight) == "2016.12.01 22:00 2016.12.02 06:00 | overnight"
+	for parse in [agenda.Appt.from_string, agenda.Appt.from_string_strict]:
+		assert str(parse(str(overnight))) == str(overnight)
+	text = "2016.12.01 09:00 2016.12.04 17:00 | conference\n2016.12.05 09:00 10:00 | meeting"
+	assert agenda.Agenda.loads(text).dumps() == text
+	try:
+		agenda.Appt.from_string("2016.12.02 09:00 2016.12.01 17:00 | backwards")
+		assert False
+	except ValueError:
+		pass
+
+def test_clip_matches_intersect():
+	rand = random.Random(33)
+	free = agenda.Agenda()
+	for day in range(1, 29):
+		free.append(agenda.Appt(datetime.date(2016, 12, day), datetime.time(9), datetime.time(17), "free time"))
+	busy = agenda.Agenda()
+	for i in range(200):
+		begin = rand.randrange(0, 27 * 24 * 60, 15)
+		end = begin + rand.randrange(15, 4 * 24 * 60, 15)
+		busy.append(agenda.Appt.from_minutes(24690240 + begin, 24690240 + end, "busy {}".format(i)))
+	clipped = busy.clip(free)
+	assert clipped.dumps() == busy.intersect(free).dumps()
+	assert all(appt.end_minute - appt.begin_minute <= 8 * 60 for appt in clipped)
+
+def test_from_events_all_day_and_multi_day():
+	pacific = datetime.timezone(datetime.timedelta(hours=-8))
+	events = [{"summary": "holiday", "start_time": "2016-12-02", "end_time": "2016-12-03"},
+		{"summary": "conference", "start_time": "2016-12-04T20:00:00-08:00", "end_time": "2016-12-06T08:00:00-08:00"},
+		{"summary": "early", "start_time": "2016-12-07T06:00:00-08:00", "end_time": "2016-12-07T07:00:00-08:00"}]
+	result = agenda.Agenda.from_events(events, datetime.time(9, tzinfo=pacific),
+		datetime.time(17, tzinfo=pacific), tzinfo=pacific)
+	assert result.dumps() == "2016.12.02 00:00 2016.12.03 00:00 | holiday\n" \
+		"2016.12.04 20:00 2016.12.06 08:00 | conference"
+	free = agenda.Agenda()
+	for day in range(1, 8):
+		free.append(agenda.Appt(datetime.date(2016, 12, day),
+			datetime.time(9, tzinfo=pacific), datetime.time(17, tzinfo=pacific), "free time"))
+	assert result.clip(free).dumps() == "2016.12.02 09:00 17:00 | holiday\n" \
+		"2016.12.05 09:00 17:00 | conference"
+
+def test_daily_across_dst():
+	pacific = tz.gettz("America/Los_Angeles")
+	for first, last, change in [(datetime.date(2016, 3, 10), datetime.date(2016, 3, 16), datetime.date(2016, 3, 13)),
+			(datetime.date(2016, 11, 3), datetime.date(2016, 11, 9), datetime.date(2016, 11, 6))]:
+		free = agenda.Agenda.daily(first, last, datetime.time(9), datetime.time(17), "free time", pacific)
+		assert len(free) == 7
+		for appt, line in zip(free, free.lines()):
+			assert line == appt.begin.strftime("%Y.%m.%d 09:00 17:00 | free time")
+			assert appt.end_minute - appt.begin_minute == 8 * 60
+		# 9:00 Pacific is 17:00 UTC in standard time, 16:00 UTC in daylight time
+		summer = [appt.begin_minute % (24 * 60) == 16 * 60 for appt in free]
+		assert summer == [(appt.begin.date() >= change) == (first.month == 3) for appt in free]
+
+def test_lines_with_time_zones():
+	rand = random.Random(44)
+	zones = [tz.gettz("America/Los_Angeles"), tz.gettz("Australia/Lord_Howe"),
+		datetime.timezone(datetime.timedelta(hours=5, minutes=30))]
+	ag = agenda.Agenda()
+	start = agenda.to_minutes(datetime.datetime(2016, 3, 1))
+	for i in range(2000):
+		begin = start + rand.randrange(0, 250 * 24 * 60)
+		ag.append(agenda.Appt.from_minutes(begin, begin + rand.randrange(1, 3 * 24 * 60),
+			"appt {}".format(i), rand.choice(zones)))
+	# Around the changes to and from daylight time in Los Angeles
+	for change in [datetime.datetime(2016, 3, 13, 10), datetime.datetime(2016, 11, 6, 9)]:
+		for delta in range(-90, 91, 15):
+			begin = agenda.to_minutes(change) + delta
+			ag.append(agenda.Appt.from_minutes(begin, begin + 30, "change", zones[0]))
+	assert list(ag.lines()) == [str(appt) for appt in ag]
+
+def test_localized():
+	pacific = tz.gettz("America/Los_Angeles")
+	ag = agenda.Agenda.loads("2016.03.12 09:00 17:00 | before\n2016.03.14 09:00 17:00 | after")
+	local = ag.localized(pacific)
+	assert [appt.begin for appt in local] == [datetime.datetime(2016, 3, 12, 9, tzinfo=pacific),
+		datetime.datetime(2016, 3, 14, 9, tzinfo=pacific)]
+	assert local.dumps() == ag.dumps()
+	assert local.localized(tz.gettz("America/New_York")).dumps() == ag.dumps()
+	normal = agenda.NormalizedAgenda()
+	normal.append(ag.appts[0])
+	assert isinstance(normal.localized(pacific), agenda.NormalizedAgenda)
+
+def test_complement_across_dst():
+	pacific = tz.gettz("America/Los_Angeles")
+	events = [{"summary": "standard", "start_time": "2016-03-11T12:00:00-08:00", "end_time": "2016-03-11T13:00:00-08:00"},
+		{"summary": "daylight", "start_time": "2016-03-14T12:00:00-07:00", "end_time": "2016-03-14T13:00:00-07:00"},
+		{"summary": "utc", "start_time": "2016-03-15T20:00:00Z", "end_time": "2016-03-15T21:00:00Z"}]
+	busy = agenda.Agenda.from_events(events, tzinfo=pacific)
+	free = agenda.Agenda.daily(datetime.date(2016, 3, 11), datetime.date(2016, 3, 15),
+		datetime.time(9), datetime.time(17), "free time", pacific)
+	assert busy.complement(free).dumps() == "\n".join([
+		"2016.03.11 09:00 12:00 | free time",
+		"2016.03.11 13:00 17:00 | free time",
+		"2016.03.12 09:00 17:00 | free time",
+		"2016.03.13 09:00 17:00 | free time",
+		"2016.03.14 09:00 12:00 | free time",
+		"2016.03.14 13:00 17:00 | free time",
+		"2016.03.15 09:00 13:00 | free time",
+		"2016.03.15 14:00 17:00 | free time"])
+	assert busy.clip(free).dumps() == "\n".join([
+		"2016.03.11 12:00 13:00 | standard",
+		"2016.03.14 12:00 13:00 | daylight",
+		"2016.03.15 13:00 14:00 | utc"])
+
+def test_from_events_normalized_agenda():
+	events = [{"summary": "b", "start_time": "2016-12-01T11:00:00Z", "end_time": "2016-12-01T12:00:00Z"},
+		{"summary": "a", "start_time": "2016-12-01T09:00:00Z", "end_time": "2016-12-01T11:30:00Z"}]
+	result = agenda.NormalizedAgenda.from_events(events)
+	assert isinstance(result, agenda.NormalizedAgenda)
+	assert result.dumps() == "2016.12.01 09:00 12:00 | a b"
+	result.append(agenda.Appt.from_string("2016.12.01 13:00 14:00 | c"))
+	assert result.dumps() == "2016.12.01 09:00 12:00 | a b\n2016.12.01 13:00 14:00 | c"
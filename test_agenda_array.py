@@ -0,0 +1,75 @@
+import agenda
+import agenda_array
+import datetime
+import numpy as np
+import random
+from dateutil import tz
+
+from test_agenda import random_agenda
+
+def random_days(rand, days, per_day):
+	"""A multi-day agenda, in random order."""
+	result = agenda.Agenda()
+	first = datetime.date(2016, 12, 1)
+	for i in range(days):
+		day = first + datetime.timedelta(days=i)
+		result.appts.extend(random_agenda(rand, rand.randrange(0, per_day), day).appts)
+	rand.shuffle(result.appts)
+	return result
+
+def test_round_trip():
+	rand = random.Random(1)
+	ag = random_days(rand, 5, 10)
+	assert str(agenda_array.AgendaArray.from_agenda(ag).to_agenda()) == str(ag)
+	assert len(agenda_array.AgendaArray.from_agenda(agenda.Agenda())) == 0
+	pacific = tz.gettz("America/Los_Angeles")
+	free = agenda.Agenda.daily(datetime.date(2016, 3, 10), datetime.date(2016, 3, 16),
+		datetime.time(9), datetime.time(17), "free time", pacific)
+	arr = agenda_array.AgendaArray.from_agenda(free)
+	assert len(arr.table) == 1
+	assert arr.to_agenda().dumps() == free.dumps()
+
+def test_normalize_matches_agenda():
+	rand = random.Random(2)
+	for trial in range(100):
+		ag = random_days(rand, 3, 12)
+		arr = agenda_array.AgendaArray.from_agenda(ag)
+		ag.normalize()
+		arr.normalize()
+		assert arr.to_agenda() == ag
+		assert str(arr.to_agenda()) == str(ag)
+
+def test_intersect_matches_agenda():
+	rand = random.Random(3)
+	for trial in range(100):
+		mine = random_days(rand, 3, 12)
+		theirs = random_days(rand, 3, 12)
+		for desc in ["", "common"]:
+			expected = mine.intersect(theirs, desc)
+			actual = agenda_array.AgendaArray.from_agenda(mine).intersect(
+				agenda_array.AgendaArray.from_agenda(theirs), desc)
+			assert str(actual.to_agenda()) == str(expected)
+
+def test_intersect_long_appointment():
+	# One appointment overlapping everything mustn't make every
+	# pair of the others a candidate
+	n = 20000
+	start = agenda.to_minutes(datetime.datetime(2016, 12, 1))
+	hours = start + 60 * np.arange(n)
+	short = agenda_array.AgendaArray(hours, hours + 30, np.zeros(n, dtype=np.int64), [("short", None)])
+	other = agenda_array.AgendaArray(np.append(hours + 15, start), np.append(hours + 45, start + 60 * n),
+		np.zeros(n + 1, dtype=np.int64), [("other", None)])
+	actual = short.intersect(other)
+	assert len(actual) == 2 * n
+	assert actual.to_agenda() == short.to_agenda().intersect(other.to_agenda())
+
+def test_complement_matches_agenda():
+	rand = random.Random(4)
+	for trial in range(100):
+		busy = random_days(rand, 4, 10)
+		free = random_days(rand, 4, 3)
+		expected = busy.complement(free)
+		actual = agenda_array.AgendaArray.from_agenda(busy).complement(
+			agenda_array.AgendaArray.from_agenda(free))
+		assert actual.to_agenda() == expected
+		assert str(actual.to_agenda()) == str(expected)
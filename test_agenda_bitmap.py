@@ -0,0 +1,68 @@
+import agenda
+import agenda_bitmap
+import datetime
+import functools
+import operator
+import random
+
+from test_agenda_array import random_days
+
+BEGIN = datetime.datetime(2016, 12, 1)
+END = datetime.datetime(2016, 12, 5)
+
+def bitmap(ag, **kwargs):
+	return agenda_bitmap.AgendaBitmap.from_agenda(ag, BEGIN, END, **kwargs)
+
+def test_round_trip():
+	rand = random.Random(5)
+	for trial in range(50):
+		ag = random_days(rand, 4, 10).normalized()
+		bits = bitmap(ag)
+		assert len(bits) == 4 * 24 * 4
+		# Appointments that only touch become one run of slots
+		assert bitmap(bits.to_agenda()) == bits
+		assert bits.count() * 15 == sum(appt.end_minute - appt.begin_minute for appt in bits.to_agenda())
+	assert bitmap(agenda.Agenda()).to_agenda().dumps() == ""
+
+def test_rounding_to_grid():
+	ag = agenda.Agenda.loads("2016.12.01 09:05 10:20 | odd")
+	assert bitmap(ag).to_agenda().dumps() == "2016.12.01 09:15 10:15 | free time"
+	assert bitmap(ag, partial=True).to_agenda().dumps() == "2016.12.01 09:00 10:30 | free time"
+	hourly = bitmap(ag, granularity=datetime.timedelta(hours=1))
+	assert len(hourly.to_agenda()) == 0
+	busy = agenda.Agenda.loads("2016.12.01 00:00 2016.12.04 23:00 | busy")
+	assert (~bitmap(busy)).to_agenda().dumps() == "2016.12.04 23:00 2016.12.05 00:00 | free time"
+	for bad in [datetime.timedelta(0), datetime.timedelta(seconds=90)]:
+		try:
+			bitmap(ag, granularity=bad)
+			assert False
+		except ValueError:
+			pass
+
+def test_intersect_all_matches_agenda():
+	rand = random.Random(6)
+	for trial in range(50):
+		agendas = [random_days(rand, 4, 8) for i in range(rand.randrange(1, 6))]
+		expected = agenda.Agenda.intersect_all(agendas)
+		bitmaps = [bitmap(ag) for ag in agendas]
+		actual = agenda_bitmap.AgendaBitmap.intersect_all(bitmaps)
+		assert actual == bitmap(expected)
+		assert actual == functools.reduce(operator.and_, bitmaps)
+
+def test_intersect_quorum_matches_agenda():
+	rand = random.Random(7)
+	for trial in range(50):
+		agendas = [random_days(rand, 4, 8) for i in range(rand.randrange(1, 8))]
+		quorum = rand.randrange(1, len(agendas) + 1)
+		expected = agenda.Agenda.intersect_quorum(agendas, quorum)
+		actual = agenda_bitmap.AgendaBitmap.intersect_quorum([bitmap(ag) for ag in agendas], quorum)
+		assert actual == bitmap(expected)
+
+def test_different_windows():
+	ag = agenda.Agenda.loads("2016.12.01 09:00 10:00 | free time")
+	other = agenda_bitmap.AgendaBitmap.from_agenda(ag, BEGIN, END - datetime.timedelta(days=1))
+	try:
+		bitmap(ag) & other
+		assert False
+	except ValueError:
+		pass
@@ -0,0 +1,32 @@
+import cache
+
+class FakeClock:
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+def test_lru_eviction():
+	lru = cache.LRUCache(max_size=2)
+	lru.put('a', 1)
+	lru.put('b', 2)
+	assert lru.get('a') == 1
+	lru.put('c', 3)
+	assert lru.get('b') is None
+	assert lru.get('a') == 1
+	assert lru.get('c') == 3
+	stats = lru.stats()
+	assert (stats['hits'], stats['misses'], stats['evictions']) == (3, 1, 1)
+	assert stats['size'] == 2
+
+def test_lru_ttl():
+	clock = FakeClock()
+	lru = cache.LRUCache(ttl=60, clock=clock)
+	lru.put('a', 1)
+	clock.now += 59
+	assert lru.get('a') == 1
+	clock.now += 1
+	assert lru.get('a', 'gone') == 'gone'
+	assert lru.stats()['expirations'] == 1
+	assert len(lru) == 0
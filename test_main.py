@@ -1,9 +1,17 @@
 import flask_main
+import agenda
 import arrow
 from dateutil import tz
 import dateutil
 import uuid
 import bson
+import time
+import threading
+import datetime
+from oauth2client import client
+import httplib2
+import mongomock
+from apiclient.errors import HttpError
 
 def test_interpret_time():
 	assert flask_main.interpret_time("10:00 am") == '2016-01-01T10:00:00-08:00'
@@ -21,4 +29,420 @@ def test_insert_database():
 	flask_main.insertToDatabase(['2016.12.11 10:00 22:00 | free time'], _id, str(begin_date), str(end_date), str(begin_time), str(end_time))
 	data = flask_main.collection.find_one({'uuid': _id})
 	assert data['uuid'] == _id
-	assert data['events'] == ['2016.12.11 10:00 22:00 | free time']
\ No newline at end of file
+	assert data['free'] == [{'begin': datetime.datetime(2016, 12, 11, 10, 0),
+				 'end': datetime.datetime(2016, 12, 11, 22, 0),
+				 'desc': 'free time'}]
+	assert data['submissions'] == []
+	assert str(flask_main.meeting_free_times(data)) == '2016.12.11 10:00 22:00 | free time'
+
+def test_meeting_free_times():
+	ag = agenda.Agenda.loads("2016.12.11 10:00 12:00 | free time\n2016.12.12 09:00 17:30 | free time")
+	docs = flask_main.free_documents(ag)
+	assert docs[1] == {'begin': datetime.datetime(2016, 12, 12, 9, 0),
+			   'end': datetime.datetime(2016, 12, 12, 17, 30),
+			   'desc': 'free time'}
+	assert flask_main.meeting_free_times({'free': docs}).dumps() == ag.dumps()
+	# Meetings stored before free times were documents
+	assert flask_main.meeting_free_times({'events': ag.dumps()}).dumps() == ag.dumps()
+
+def test_meeting_cache():
+	_id = str(uuid.uuid4())
+	flask_main.insertToDatabase(['2016.12.12 09:00 17:00 | free time'], _id, '2016-12-12T00:00:00-08:00',
+				    '2016-12-13T00:00:00-08:00', '2016-01-01T09:00:00-08:00', '2016-01-01T17:00:00-08:00')
+	client = flask_main.app.test_client()
+	hits = flask_main.meeting_cache.hits
+	assert client.get('/schedule/' + _id).status_code == 200
+	assert client.get('/invitee/' + _id).status_code == 200
+	assert flask_main.meeting_cache.hits == hits + 1
+	view = flask_main.meeting_view(_id)
+	assert view['formattedBeginTime'] == '09:00'
+	assert view['events'] == ['2016.12.12 09:00 17:00 | free time']
+	# The invitee's submission changes the meeting, so its entry is dropped
+	with client.session_transaction() as session:
+		session['events'] = ['2016.12.12 12:00 18:00 | free time']
+	client.post('/deleteEventsCombine', data={})
+	assert flask_main.meeting_cache.get(_id) is None
+	assert flask_main.meeting_view(_id)['events'] == ['2016.12.12 12:00 17:00 | free time']
+	assert client.get('/schedule/' + str(uuid.uuid4())).status_code == 404
+
+class ChangingCollection:
+	"""The meetings collection, with an invitee's submission merged
+	(and the meeting's cache entry dropped) just after the first
+	read of a whole meeting: a reader racing deleteEventsCombine."""
+	def __init__(self, collection, uuid, freeAgenda):
+		self.collection = collection
+		self.uuid = uuid
+		self.freeAgenda = freeAgenda
+
+	def find_one(self, *args, **kwargs):
+		record = self.collection.find_one(*args, **kwargs)
+		if self.freeAgenda is not None and len(args) == 1:
+			flask_main.merge_submission(self.collection, self.uuid, self.freeAgenda)
+			flask_main.meeting_cache.delete(self.uuid)
+			self.freeAgenda = None
+		return record
+
+def test_meeting_cache_race():
+	_id = str(uuid.uuid4())
+	flask_main.insertToDatabase(['2016.12.12 09:00 17:00 | free time'], _id, '2016-12-12T00:00:00-08:00',
+				    '2016-12-13T00:00:00-08:00', '2016-01-01T09:00:00-08:00', '2016-01-01T17:00:00-08:00')
+	collection = flask_main.collection
+	flask_main.collection = ChangingCollection(collection, _id,
+		agenda.Agenda.loads("2016.12.12 12:00 18:00 | free time"))
+	try:
+		assert flask_main.meeting_view(_id)['events'] == ['2016.12.12 09:00 17:00 | free time']
+		assert flask_main.meeting_cache.get(_id) is None
+		assert flask_main.meeting_view(_id)['events'] == ['2016.12.12 12:00 17:00 | free time']
+		assert flask_main.meeting_cache.get(_id) is not None
+	finally:
+		flask_main.collection = collection
+
+class SlowCollection:
+	"""A mongomock collection whose reads take a while, so that
+	simultaneous invitees all read before any of them writes."""
+	def __init__(self, collection, latency):
+		self.collection = collection
+		self.latency = latency
+		self.updates = 0
+
+	def find_one(self, *args, **kwargs):
+		record = self.collection.find_one(*args, **kwargs)
+		time.sleep(self.latency)
+		return record
+
+	def update_one(self, *args, **kwargs):
+		self.updates += 1
+		return self.collection.update_one(*args, **kwargs)
+
+	def insert_one(self, *args, **kwargs):
+		return self.collection.insert_one(*args, **kwargs)
+
+def test_merge_submission_concurrent():
+	meetings = SlowCollection(mongomock.MongoClient().db.dated, 0.01)
+	meetings.insert_one({'uuid': 'meeting', 'version': 0, 'submissions': [],
+			     'free': flask_main.free_documents(agenda.Agenda.loads("2016.12.12 08:00 20:00 | free time"))})
+	invitees = []
+	for i in range(20):
+		# Invitee i is free from 8:00 until 19:00 less i*15 minutes
+		end = 19 * 60 - i * 15
+		invitees.append(agenda.Agenda.loads("2016.12.12 08:00 {:02}:{:02} | free time".format(end // 60, end % 60)))
+	start = threading.Barrier(len(invitees))
+	def submit(freeAgenda):
+		start.wait()
+		flask_main.merge_submission(meetings, 'meeting', freeAgenda)
+	threads = [threading.Thread(target=submit, args=(freeAgenda,)) for freeAgenda in invitees]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	record = meetings.find_one({'uuid': 'meeting'})
+	assert record['version'] == 20
+	assert len(record['submissions']) == 20
+	assert flask_main.meeting_free_times(record).dumps() == "2016.12.12 08:00 14:15 | free time"
+	# Some updates lost the race and were retried
+	assert meetings.updates > 20
+
+def test_merge_submission_legacy():
+	meetings = mongomock.MongoClient().db.dated
+	meetings.insert_one({'uuid': 'meeting', 'events': ['2016.12.12 09:00 17:00 | free time']})
+	flask_main.merge_submission(meetings, 'meeting', agenda.Agenda.loads("2016.12.12 12:00 18:00 | free time"))
+	record = meetings.find_one({'uuid': 'meeting'})
+	assert record['version'] == 1
+	assert flask_main.meeting_free_times(record).dumps() == "2016.12.12 12:00 17:00 | free time"
+
+def test_merge_submission_time_zones():
+	_id = str(uuid.uuid4())
+	# The maker is in Los Angeles, the invitee in New York; both are free 9 to 5 their time
+	flask_main.insertToDatabase(['2016.12.12 09:00 17:00 | free time'], _id, '2016-12-12T00:00:00-08:00',
+				    '2016-12-13T00:00:00-08:00', '2016-01-01T09:00:00-08:00', '2016-01-01T17:00:00-08:00',
+				    'America/Los_Angeles')
+	record = flask_main.collection.find_one({'uuid': _id})
+	assert record['tz'] == 'America/Los_Angeles'
+	assert record['free'][0]['begin'] == datetime.datetime(2016, 12, 12, 17, 0)
+	flask_main.merge_submission(flask_main.collection, _id, agenda.Agenda.loads("2016.12.12 09:00 17:00 | free time"),
+				    flask_main.time_zone('America/New_York'))
+	record = flask_main.collection.find_one({'uuid': _id})
+	assert flask_main.meeting_free_times(record).dumps() == "2016.12.12 09:00 14:00 | free time"
+	assert record['submissions'][0]['free'][0]['begin'] == datetime.datetime(2016, 12, 12, 14, 0)
+	# Without a time zone, the invitee is taken to be in the meeting's
+	flask_main.merge_submission(flask_main.collection, _id, agenda.Agenda.loads("2016.12.12 10:00 17:00 | free time"))
+	record = flask_main.collection.find_one({'uuid': _id})
+	assert flask_main.meeting_free_times(record).dumps() == "2016.12.12 10:00 14:00 | free time"
+
+class FakeRequest:
+	"""Stands in for the request returned by service.events().list()."""
+	def __init__(self, service, kwargs):
+		self.service = service
+		self.kwargs = kwargs
+
+	def execute(self, http=None):
+		self.service.requests.append(self.kwargs)
+		return self.service.respond(self.kwargs)
+
+class FakeEvents:
+	def __init__(self, service):
+		self.service = service
+
+	def list(self, **kwargs):
+		return FakeRequest(self.service, kwargs)
+
+class FakeFreebusy:
+	"""Answers service.freebusy().query() from the fake's events."""
+	def __init__(self, service):
+		self.service = service
+
+	def query(self, body):
+		return FakeRequest(self.service, {'freebusy': body})
+
+class FakeService:
+	"""A local fake of the Google calendar service's events().list()
+	interface.  calendars maps a calendar id to its list of events;
+	latency maps a calendar id to seconds to wait before answering,
+	and a calendar missing from calendars raises an error.
+	A request with a syncToken gets the events in changes, or
+	a 410 error if the token is in expired."""
+	def __init__(self, calendars, latency={}):
+		self.calendars = calendars
+		self.latency = latency
+		self.requests = []
+		self.changes = {}
+		self.expired = set()
+
+	def events(self):
+		return FakeEvents(self)
+
+	def freebusy(self):
+		return FakeFreebusy(self)
+
+	def respond(self, kwargs):
+		if 'freebusy' in kwargs:
+			calendars = {}
+			for item in kwargs['freebusy']['items']:
+				cal = item['id']
+				if cal in self.calendars:
+					calendars[cal] = {'busy': [{'start': e['start']['dateTime'], 'end': e['end']['dateTime']}
+						for e in self.calendars[cal]]}
+				else:
+					calendars[cal] = {'errors': [{'domain': 'global', 'reason': 'notFound'}]}
+			return {'calendars': calendars}
+		cal = kwargs['calendarId']
+		time.sleep(self.latency.get(cal, 0))
+		if cal not in self.calendars:
+			raise KeyError(cal)
+		events = self.calendars[cal]
+		if kwargs.get('syncToken') in self.expired:
+			raise HttpError(httplib2.Response({'status': 410}), b'Sync token is no longer valid')
+		if kwargs.get('syncToken'):
+			events = self.changes.pop(cal, [])
+		if not kwargs.get('maxResults'):
+			return {'items': events}
+		first = int(kwargs.get('pageToken') or 0)
+		last = first + kwargs['maxResults']
+		page = {'items': events[first:last]}
+		if last < len(events):
+			page['nextPageToken'] = str(last)
+		else:
+			page['nextSyncToken'] = 'sync {}'.format(len(self.requests))
+		return page
+
+def fake_event(summary, start, end):
+	return {'id': summary, 'summary': summary, 'start': {'dateTime': start}, 'end': {'dateTime': end}}
+
+def test_fetch_events_concurrently():
+	calendars = {}
+	for i in range(8):
+		calendars[str(i)] = [fake_event('event {}'.format(i),
+			'2016-12-0{}T10:00:00-08:00'.format(i + 1), '2016-12-0{}T11:00:00-08:00'.format(i + 1))]
+	service = FakeService(calendars, dict((cal, 0.2) for cal in calendars))
+	start = time.time()
+	events, failures = flask_main.fetch_events(service, '2016-12-01', '2016-12-10', sorted(calendars))
+	assert time.time() - start < 0.2 * 4
+	assert failures == {}
+	assert [e['summary'] for e in events] == ['event {}'.format(i) for i in range(8)]
+
+def test_fetch_events_partial_failure():
+	service = FakeService({'fast': [fake_event('fast', '2016-12-01T10:00:00-08:00', '2016-12-01T11:00:00-08:00')],
+		'slow': []}, {'slow': 1})
+	events, failures = flask_main.fetch_events(service, '2016-12-01', '2016-12-10',
+		['fast', 'slow', 'missing'], deadline=0.3)
+	assert [e['summary'] for e in events] == ['fast']
+	assert sorted(failures) == ['missing', 'slow']
+	assert 'timed out' in failures['slow']
+
+def test_fetch_events_hung_calendar_spares_others():
+	# Many requests stuck on a hung calendar don't delay anyone else's
+	hung = FakeService({'hung': []}, {'hung': 2})
+	for i in range(flask_main.FETCH_WORKERS + 1):
+		flask_main.fetch_events(hung, '2016-12-01', '2016-12-10', ['hung'], deadline=0.05)
+	service = FakeService({'cal': [fake_event('event', '2016-12-01T10:00:00-08:00', '2016-12-01T11:00:00-08:00')]})
+	events, failures = flask_main.fetch_events(service, '2016-12-01', '2016-12-10', ['cal'], deadline=0.5)
+	assert failures == {}
+	assert [e['summary'] for e in events] == ['event']
+
+def test_fetch_busy():
+	service = FakeService({'work': [fake_event('meeting', '2016-12-02T10:00:00-08:00', '2016-12-02T11:00:00-08:00')],
+		'home': [fake_event('dentist', '2016-12-01T09:00:00-08:00', '2016-12-01T09:30:00-08:00')]})
+	events, failures = flask_main.fetch_busy(service, '2016-12-01', '2016-12-10', ['work', 'home', 'missing'])
+	assert len(service.requests) == 1
+	assert failures == {'missing': 'notFound'}
+	assert events == [
+		{'summary': 'busy', 'start_time': '2016-12-01T09:00:00-08:00', 'end_time': '2016-12-01T09:30:00-08:00'},
+		{'summary': 'busy', 'start_time': '2016-12-02T10:00:00-08:00', 'end_time': '2016-12-02T11:00:00-08:00'}]
+
+def test_iter_events_pages():
+	events = [fake_event('event {}'.format(i), '2016-12-01T{:02d}:00:00-08:00'.format(i),
+		'2016-12-01T{:02d}:30:00-08:00'.format(i)) for i in range(10)]
+	events[3]['transparency'] = 'transparent'
+	service = FakeService({'cal': events})
+	pages = flask_main.iter_events(service, '2016-12-01', '2016-12-02', 'cal', page_size=4)
+	first = next(pages)
+	assert first['summary'] == 'event 0'
+	assert len(service.requests) == 1
+	rest = list(pages)
+	assert len(service.requests) == 3
+	assert [e['summary'] for e in [first] + rest] == ['event {}'.format(i) for i in range(10) if i != 3]
+	assert all(request['singleEvents'] and request['maxResults'] == 4 for request in service.requests)
+	assert [request['pageToken'] for request in service.requests] == [None, '4', '8']
+	# sync_events fetches everything the same way, and gets a sync token
+	sync = {}
+	pages = flask_main.iter_events(service, '2016-12-01', '2016-12-02', 'cal', page_size=4, sync=sync)
+	assert len(list(pages)) == 9
+	assert sync['sync_token'] == 'sync 6'
+	assert 'orderBy' not in service.requests[-1]
+
+def test_event_record_all_day():
+	event = {'id': 'holiday', 'summary': 'holiday', 'start': {'date': '2016-12-02'}, 'end': {'date': '2016-12-03'}}
+	record = flask_main.event_record(event)
+	assert (record['start_time'], record['end_time']) == ('2016-12-02', '2016-12-03')
+	record = flask_main.event_record(fake_event('trip', '2016-12-01T20:00:00-08:00', '2016-12-03T08:00:00-08:00'))
+	assert str(agenda.Agenda.from_events([record])) == '2016.12.01 20:00 2016.12.03 08:00 | trip'
+
+def test_time_zone():
+	pacific = flask_main.time_zone('America/Los_Angeles')
+	assert pacific is flask_main.time_zone('America/Los_Angeles')
+	assert datetime.datetime(2016, 3, 14, 9, tzinfo=pacific).isoformat() == '2016-03-14T09:00:00-07:00'
+	assert isinstance(flask_main.time_zone('Not/A_Zone'), tz.tzlocal)
+	assert isinstance(flask_main.time_zone(None), tz.tzlocal)
+	for name in ['/etc/passwd', '../../../../etc/passwd', 'America/../../etc/passwd']:
+		assert isinstance(flask_main.time_zone(name), tz.tzlocal)
+	assert flask_main.time_zone.cache_info().maxsize is not None
+
+def test_sync_events():
+	user = str(uuid.uuid4())
+	service = FakeService({'cal': [
+		fake_event('standup', '2016-12-01T09:00:00-08:00', '2016-12-01T09:15:00-08:00'),
+		fake_event('lunch', '2016-12-01T12:00:00-08:00', '2016-12-01T13:00:00-08:00')]})
+	misses = flask_main.event_cache.stats()['misses']
+	events = flask_main.sync_events(service, '2016-12-01', '2016-12-02', 'cal', user)
+	assert [e['summary'] for e in events] == ['standup', 'lunch']
+	assert flask_main.event_cache.stats()['misses'] == misses + 1
+
+	service.changes['cal'] = [{'id': 'standup', 'status': 'cancelled'},
+		fake_event('lunch', '2016-12-01T11:30:00-08:00', '2016-12-01T12:30:00-08:00'),
+		fake_event('review', '2016-12-01T15:00:00-08:00', '2016-12-01T16:00:00-08:00'),
+		# Changes come for the whole calendar, not just the range
+		fake_event('next week', '2016-12-08T09:00:00-08:00', '2016-12-08T10:00:00-08:00'),
+		fake_event('night before', '2016-11-30T22:00:00-08:00', '2016-12-01T00:00:00-08:00'),
+		fake_event('overnight', '2016-11-30T22:00:00-08:00', '2016-12-01T01:00:00-08:00')]
+	events = flask_main.sync_events(service, '2016-12-01', '2016-12-02', 'cal', user)
+	assert service.requests[-1]['syncToken'] == 'sync 1'
+	assert 'timeMin' not in service.requests[-1]
+	assert [(e['summary'], e['start_time']) for e in events] == [('overnight', '2016-11-30T22:00:00-08:00'),
+		('lunch', '2016-12-01T11:30:00-08:00'), ('review', '2016-12-01T15:00:00-08:00')]
+	key = "{}|cal|2016-12-01|2016-12-02".format(user)
+	assert len(flask_main.event_cache.get(key)['events']) == 3
+
+	service.expired.add('sync 2')
+	events = flask_main.sync_events(service, '2016-12-01', '2016-12-02', 'cal', user)
+	assert service.requests[-1]['timeMin'] == '2016-12-01'
+	assert [e['summary'] for e in events] == ['standup', 'lunch']
+
+def test_rfc3339_before():
+	assert flask_main.rfc3339_before('2016-12-01T09:00:00-08:00', '2016-12-01T15:00:00-03:00')
+	assert not flask_main.rfc3339_before('2016-12-01T09:00:00-08:00', '2016-12-01T14:00:00-03:00')
+	assert flask_main.rfc3339_before('2016-12-01T09:00:00.000Z', '2016-12-01T09:00:01Z')
+	# Dates are in the other time's zone
+	assert flask_main.rfc3339_before('2016-12-01T23:00:00-08:00', '2016-12-02')
+	assert not flask_main.rfc3339_before('2016-12-02', '2016-12-02T00:00:00+05:00')
+	assert flask_main.rfc3339_before('2016-12-01', '2016-12-02')
+
+def test_pooled_http():
+	first = flask_main.pooled_http()
+	second = flask_main.pooled_http()
+	assert first is not second
+	assert first.connections is second.connections
+	other = []
+	thread = threading.Thread(target=lambda: other.append(flask_main.pooled_http()))
+	thread.start()
+	thread.join()
+	assert other[0].connections is not first.connections
+	assert flask_main.pooled_http(5).timeout == 5
+
+class FakeConnection:
+	"""Stands in for an open httplib2 connection."""
+	def __init__(self):
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+
+def test_fetch_reuses_connections():
+	# Each request has its own fetch threads, so connections are
+	# passed from one to the next through the shared pool
+	key = 'https:reuse.example.com'
+	seen = []
+	def fetch(http=None):
+		seen.append(http.connections.get(key))
+		http.connections.setdefault(key, FakeConnection())
+		return []
+	for request in range(3):
+		pool = flask_main.ThreadPoolExecutor(max_workers=1)
+		pool.submit(flask_main.fetch_with_http, httplib2.Http, fetch).result()
+		pool.shutdown()
+	assert seen[0] is None
+	assert seen[1] is not None and seen[2] is seen[1]
+	assert not seen[1].closed
+	# A connection can only be checked out once at a time
+	assert key in flask_main.checkout_connections()
+	assert key not in flask_main.checkout_connections()
+
+def test_failed_fetch_closes_connections():
+	key = 'https:failure.example.com'
+	conn = FakeConnection()
+	flask_main.checkin_connections({key: conn})
+	def fetch(http=None):
+		raise ValueError("broken")
+	try:
+		flask_main.fetch_with_http(httplib2.Http, fetch)
+		assert False
+	except ValueError:
+		pass
+	assert conn.closed
+	assert key not in flask_main.checkout_connections()
+
+class SlowRefreshCredentials(client.OAuth2Credentials):
+	"""Credentials whose refresh takes a while and is counted,
+	instead of calling Google."""
+	refreshes = []
+
+	def refresh(self, http):
+		self.refreshes.append(self)
+		time.sleep(0.1)
+		self.access_token = 'new token'
+		self.token_expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+def test_refresh_credentials_once():
+	expired = client.OAuth2Credentials('old token', 'client', 'secret', str(uuid.uuid4()),
+		datetime.datetime.utcnow() - datetime.timedelta(minutes=1), 'https://example.com/token', 'test')
+	assert expired.access_token_expired
+	results = []
+	def request():
+		credentials = SlowRefreshCredentials.from_json(expired.to_json())
+		results.append(flask_main.refresh_credentials(credentials))
+	threads = [threading.Thread(target=request) for i in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert len(SlowRefreshCredentials.refreshes) == 1
+	assert [credentials.access_token for credentials in results] == ['new token'] * 8
@@ -0,0 +1,69 @@
+import flask
+import cache
+import session_store
+
+def make_app(store):
+	app = flask.Flask(__name__)
+	app.secret_key = 'test'
+	app.session_interface = session_store.ServerSideSessionInterface(store)
+
+	@app.route('/add/<item>')
+	def add(item):
+		flask.session.setdefault('events', [])
+		flask.session['events'].append(item)
+		return ''
+
+	@app.route('/events')
+	def events():
+		return ','.join(flask.session.get('events', []))
+
+	@app.route('/add_unsaved/<item>')
+	def add_unsaved(item):
+		# What is stored while the request is still running
+		flask.session['events'].append(item)
+		return ','.join(store.get(flask.session.sid)['events'])
+
+	@app.route('/logout')
+	def logout():
+		flask.session.clear()
+		return ''
+
+	return app
+
+def test_session_kept_on_server():
+	store = cache.LRUCache()
+	client = make_app(store).test_client()
+	for i in range(100):
+		response = client.get('/add/2016.12.01 10:00 11:00 | event {}'.format(i))
+	cookie = response.headers['Set-Cookie']
+	assert len(cookie) < 200
+	assert len(store) == 1
+	assert client.get('/events').get_data(as_text=True).count('event') == 100
+	client.get('/logout')
+	assert len(store) == 0
+
+def test_sessions_are_separate():
+	store = cache.LRUCache()
+	app = make_app(store)
+	first = app.test_client()
+	second = app.test_client()
+	first.get('/add/a')
+	second.get('/add/b')
+	first.get('/add/c')
+	assert first.get('/events').get_data(as_text=True) == 'a,c'
+	assert second.get('/events').get_data(as_text=True) == 'b'
+
+def test_empty_session_sets_no_cookie():
+	store = cache.LRUCache()
+	response = make_app(store).test_client().get('/events')
+	assert 'Set-Cookie' not in response.headers
+	assert len(store) == 0
+
+def test_stored_session_is_a_copy():
+	store = cache.LRUCache()
+	app = make_app(store)
+	client = app.test_client()
+	client.get('/add/a')
+	# Changed in place, but not stored until the request ends
+	assert client.get('/add_unsaved/b').get_data(as_text=True) == 'a'
+	assert client.get('/events').get_data(as_text=True) == 'a,b'